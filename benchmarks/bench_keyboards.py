@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Klaviatura va matn shablonlari uchun mikro-benchmark.
+
+Har bir update uchun eski usul (har safar yangi pydantic obyektlar va
+`+=` bilan matn yig'ish) va keshlangan klaviaturalar/shablonlarni
+solishtiradi: vaqt va ajratilgan xotira (tracemalloc).
+
+    python benchmarks/bench_keyboards.py
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SPONSOR_CHANNELS", "@kanal_bir,@kanal_ikki,@kanal_uch")
+
+import stars_referal_bot as bot_module  # noqa: E402
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup  # noqa: E402
+
+# Bazaga ulanmasdan: kanallar ro'yxatini to'g'ridan-to'g'ri keshga yozamiz
+bot_module.channel_store.channels = tuple(bot_module.settings.sponsor_channels_list)
+
+ITERATIONS = 20000
+
+
+def legacy_main_menu():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="⭐ Balans"), KeyboardButton(text="👥 Referallar")],
+            [KeyboardButton(text="🔗 Referal havola"), KeyboardButton(text="⭐ Stars yechib olish")],
+            [KeyboardButton(text="📞 Admin bilan aloqa")]
+        ],
+        resize_keyboard=True
+    )
+
+
+def legacy_restricted_menu():
+    channels = bot_module.settings.sponsor_channels_list
+    channel_buttons = []
+    for channel in channels:
+        channel_url = f"https://t.me/{channel.lstrip('@')}"
+        channel_buttons.append([InlineKeyboardButton(text=f"📺 {channel}", url=channel_url)])
+    channel_buttons.append([InlineKeyboardButton(text=" Obunani tekshirish 🔍", callback_data="check_subscription")])
+    return InlineKeyboardMarkup(inline_keyboard=channel_buttons)
+
+
+def legacy_incomplete_text(channels, subscribed, unsubscribed):
+    text = f"❌ Obuna to'liq emas!\n\n"
+    text += f"📊 Jami kanallar: {len(channels)} ta\n"
+    text += f"✅ Obuna bo'lgan: {len(subscribed)} ta\n"
+    text += f"❌ Obuna bo'lmagan: {len(unsubscribed)} ta\n\n"
+    text += f"🔽 Obuna bo'lmagan kanallar:\n"
+    for channel in unsubscribed:
+        text += f"• {channel}\n"
+    text += f"\n📱 Quyi tugmalarni bosib obuna bo'ling!\n\n"
+    text += f"⚠️ Diqqat: Obuna bo'lmaganingiz uchun:\n"
+    text += f"• Referallaringizdan bonuslar olinmaydi\n"
+    text += f"• Stars yechib olish imkonsiz\n"
+    text += f"• Botning barcha funktsiyalari cheklangan\n\n"
+    text += f"🔄 Obuna bo'lgandan so'ng 'Obunani qayta tekshirish' tugmasini bosing!"
+    return text
+
+
+def legacy_update():
+    channels = bot_module.settings.sponsor_channels_list
+    legacy_main_menu()
+    legacy_restricted_menu()
+    legacy_incomplete_text(channels, channels[:1], channels[1:])
+
+
+def cached_update():
+    channels = bot_module.channel_store.channels
+    bot_module.main_menu()
+    bot_module.restricted_menu()
+    bot_module.SUBSCRIPTION_INCOMPLETE_TEMPLATE.format(
+        total=len(channels),
+        subscribed=1,
+        unsubscribed=len(channels) - 1,
+        channels="\n".join(f"• {channel}" for channel in channels[1:]),
+    )
+
+
+def measure(name, func):
+    func()  # keshlarni isitish
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    elapsed = time.perf_counter() - start
+
+    # Bitta update davomida ajratilgan xotira cho'qqisi (vaqtinchalik obyektlar bilan)
+    tracemalloc.start()
+    peaks = []
+    for _ in range(100):
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - baseline)
+    tracemalloc.stop()
+    peaks.sort()
+
+    print(f"{name:>8}: {elapsed / ITERATIONS * 1e6:8.2f} us/update, {peaks[len(peaks) // 2]:6d} B ajratiladi/update")
+    return elapsed, peaks[len(peaks) // 2]
+
+
+def main():
+    print(f"{ITERATIONS} ta update, kanallar: {bot_module.settings.sponsor_channels_list}")
+    legacy_time, legacy_bytes = measure("legacy", legacy_update)
+    cached_time, cached_bytes = measure("cached", cached_update)
+    print(f"Tezlashish: {legacy_time / cached_time:.1f}x, xotira: {legacy_bytes / max(cached_bytes, 1):.1f}x kam")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Yuklama testlari uchun lokal soxta Telegram Bot API (aiohttp).
+
+Bot `TelegramAPIServer.from_base(url)` orqali shu serverga ulanadi.
+Qo'llab-quvvatlanadigan metodlar: getMe, getUpdates, deleteWebhook,
+sendMessage, getChatMember, forwardMessage, copyMessage, editMessageText,
+answerCallbackQuery, sendChatAction. Har bir javobga kechikish qo'shish va
+tasodifiy 429 (retry_after) qaytarish mumkin.
+
+    python benchmarks/fake_bot_api.py --port 8081 --latency 0.05 --rate-limit-ratio 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Optional
+
+from aiohttp import web
+
+BOT_ID = 100000001
+BOT_USERNAME = "bench_stars_bot"
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, rate_limit_ratio: float = 0.0, retry_after: int = 1,
+                 member_ratio: float = 1.0, seed: Optional[int] = None):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.member_ratio = member_ratio
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self._updates: Deque[Dict[str, Any]] = deque()
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self._members: Dict[tuple, bool] = {}
+        self.blocked = set()  # Botni bloklagan foydalanuvchilar (403)
+        self.sent: Dict[int, list] = {}
+        self.methods = {
+            "getme": self.get_me,
+            "getupdates": self.get_updates,
+            "deletewebhook": self.ok_true,
+            "setwebhook": self.ok_true,
+            "answercallbackquery": self.ok_true,
+            "sendchataction": self.ok_true,
+            "deletemessage": self.ok_true,
+            "sendmessage": self.send_message,
+            "forwardmessage": self.send_message,
+            "editmessagetext": self.send_message,
+            "copymessage": self.copy_message,
+            "getchatmember": self.get_chat_member,
+        }
+
+    # ---------- update generator uchun ----------
+    def push_update(self, update: Dict[str, Any]) -> int:
+        self._update_id += 1
+        update["update_id"] = self._update_id
+        self._updates.append(update)
+        self._new_updates.set()
+        return self._update_id
+
+    @property
+    def pending_updates(self) -> int:
+        return len(self._updates)
+
+    def set_member(self, user_id: int, channel: str, is_member: bool):
+        self._members[(user_id, channel)] = is_member
+
+    # ---------- metodlar ----------
+    def _message(self, chat_id: int, text: Optional[str] = None) -> Dict[str, Any]:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    async def ok_true(self, params: Dict[str, Any]):
+        return True
+
+    async def get_me(self, params: Dict[str, Any]):
+        return {
+            "id": BOT_ID,
+            "is_bot": True,
+            "first_name": "Bench",
+            "username": BOT_USERNAME,
+            "can_join_groups": True,
+            "can_read_all_group_messages": False,
+            "supports_inline_queries": False,
+        }
+
+    async def get_updates(self, params: Dict[str, Any]):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        # Tasdiqlangan (offset dan kichik) updatelarni tashlab yuborish
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [update for _, update in zip(range(limit), self._updates)]
+
+    async def send_message(self, params: Dict[str, Any]):
+        chat_id = int(params.get("chat_id") or 0)
+        self.sent.setdefault(chat_id, []).append(params.get("text") or "")
+        return self._message(chat_id, params.get("text") or "")
+
+    async def copy_message(self, params: Dict[str, Any]):
+        self._message_id += 1
+        return {"message_id": self._message_id}
+
+    async def get_chat_member(self, params: Dict[str, Any]):
+        user_id = int(params["user_id"])
+        key = (user_id, params.get("chat_id"))
+        if key not in self._members:
+            self._members[key] = self.random.random() < self.member_ratio
+        return {
+            "status": "member" if self._members[key] else "left",
+            "user": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+        }
+
+    # ---------- HTTP ----------
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        handler = self.methods.get(method)
+        if handler is None:
+            return web.json_response(
+                {"ok": False, "error_code": 404, "description": "Not Found: method not found"}, status=404
+            )
+
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+            params.update(request.query)
+
+        chat_id = params.get("chat_id")
+        if method not in ("getupdates", "getchatmember") and chat_id and int(chat_id) in self.blocked:
+            return web.json_response({
+                "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+            }, status=403)
+
+        if method != "getupdates":
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio:
+                self.rate_limited[method] += 1
+                return web.json_response({
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, status=429)
+
+        result = await handler(params)
+        return web.json_response({"ok": True, "result": result}, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+        runner = web.AppRunner(self.build_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soxta Telegram Bot API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="Har bir javob kechikishi (s)")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="429 qaytarish ehtimoli (0..1)")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--member-ratio", type=float, default=1.0, help="getChatMember 'member' ehtimoli")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency, args.rate_limit_ratio, args.retry_after, args.member_ratio)
+    web.run_app(api.build_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,49 +4,45 @@ Telegram Stars Referal Bot - Simple Working Version
 """
 
 import asyncio
+import bisect
+import hashlib
+import json
 import logging
+import logging.handlers
+import queue
 import sys
 import os
 import re
-from datetime import datetime
-from typing import List
-
-from aiogram import Bot, Dispatcher, F, types
+import signal
+import socket
+import time
+import uuid
+from collections import OrderedDict, deque
+from functools import lru_cache
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton
-from aiogram.exceptions import TelegramAPIError
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Integer, Boolean, DateTime, BigInteger, Text, select, update, func
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
+from sqlalchemy import String, Integer, Boolean, DateTime, BigInteger, Text, Index, select, update, delete, insert, func, inspect, case, literal, or_, and_, true
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.event import listens_for
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
 from pydantic_settings import BaseSettings
 
-# ==================== LOGGING ====================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
-# Log yozish funksiyasi
-def log_info(message: str):
-    """Log yozish uchun qulay funktsiya"""
-    logger.info(message)
-    print(f"INFO: {message}")
-
-def log_error(message: str):
-    """Xatolik log yozish uchun qulay funktsiya"""
-    logger.error(message)
-    print(f"ERROR: {message}")
-
-def log_debug(message: str):
-    """Debug log yozish uchun qulay funktsiya"""
-    logger.debug(message)
-    print(f"DEBUG: {message}")
-
 # ==================== CONFIG ====================
 class Config(BaseSettings):
     bot_token: str = "BOT TOKEN"
@@ -55,8 +51,68 @@ class Config(BaseSettings):
     database_url: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///stars_bot.db").replace("postgresql://", "postgresql+asyncpg://")
     referral_reward: int = 3  # 3 stars
     minimum_withdrawal: int = 30  # 30 stars
-    sponsor_channels: str = "@shohjahon_shahriyev"  # Default kanal
+    sponsor_channels: str = "@shohjahon_shahriyev"  # Default kanal (birinchi ishga tushishda bazaga yoziladi)
     is_railway: bool = os.getenv("RAILWAY_ENVIRONMENT", "").startswith("production") or os.getenv("IS_RAILWAY", "false").lower() == "true"
+    # Obuna keshi: a'zo bo'lganlar uzoqroq, a'zo bo'lmaganlar qisqa vaqt saqlanadi
+    subscription_cache_ttl: float = 300.0
+    subscription_cache_negative_ttl: float = 30.0
+    subscription_cache_size: int = 10000
+    subscription_check_concurrency: int = 5
+    channels_poll_interval: float = 10.0  # Boshqa replikalardagi o'zgarishlarni tekshirish
+    # Foydalanuvchi bo'yicha cheklov: sekundiga throttle_rate ta, throttle_burst tagacha
+    throttle_rate: float = 2.0
+    throttle_burst: int = 5
+    user_state_max_size: int = 10000
+    user_state_idle_ttl: float = 300.0
+    stats_recompute_interval: float = 3600.0  # Hisoblagichlarni to'liq qayta hisoblash (drift tuzatish)
+    # Xabar yuborish (broadcast) sozlamalari - Telegram limitlari: ~30 xabar/s, 1 xabar/s bitta chatga
+    broadcast_rate_limit: float = 25.0
+    broadcast_concurrency: int = 10
+    broadcast_max_retries: int = 3
+    broadcast_progress_interval: float = 5.0
+    broadcast_batch_size: int = 500
+    broadcast_checkpoint_interval: float = 1.0
+    broadcast_lease: float = 60.0  # Shuncha vaqt heartbeat bo'lmasa boshqa replika davom ettiradi
+    referrals_page_size: int = 10
+    # Fon rejimida referallar obunasini qayta tekshirish (jarima uchun)
+    penalty_sweep_interval: float = 3600.0  # To'liq aylanishlar orasidagi pauza, 0 - o'chirilgan
+    penalty_sweep_rate: float = 5.0  # Sekundiga getChatMember so'rovlari
+    penalty_sweep_batch_size: int = 100
+    # Fon vazifasi lease i: egasi to'xtasa boshqa replika interval + shuncha vaqtdan keyin oladi
+    background_lease: float = 300.0
+    # Botni bloklaganlarni qayta tekshirish (sendChatAction), 0 - o'chirilgan.
+    # Blokdan chiqargan foydalanuvchi bir marta "typing..." ni ko'radi, keyin u tiklanadi
+    reachability_probe_interval: float = 6 * 3600.0
+    reachability_probe_rate: float = 1.0  # Sekundiga so'rovlar - broadcastdan ancha past
+    reachability_probe_batch_size: int = 100
+    withdrawals_page_size: int = 10
+    # Ishga tushirish rejimi: polling yoki webhook (bir nechta replika uchun)
+    run_mode: str = "polling"
+    webhook_url: str = ""  # Masalan: https://bot.up.railway.app
+    webhook_path: str = "/webhook"
+    webhook_secret: str = ""
+    web_host: str = "0.0.0.0"
+    web_port: int = int(os.getenv("PORT", "8080"))
+    # Loglar: JSON formati Railway uchun, fayl hajm bo'yicha aylantiriladi
+    log_level: str = "INFO"
+    log_json: Optional[bool] = None  # None - Railwayda JSON, lokal matn
+    log_file: str = "bot.log"
+    log_file_max_bytes: int = 10 * 1024 * 1024
+    log_file_backup_count: int = 5
+    # /metrics alohida listenerda (webhook portida emas) - standart faqat lokal
+    metrics_enabled: bool = True
+    metrics_host: str = "127.0.0.1"  # Ichki tarmoqdan yig'ish uchun ichki IP ni bering
+    metrics_port: int = 9100
+    metrics_token: str = ""  # Berilsa "Authorization: Bearer <token>" talab qilinadi
+    per_chat_interval: float = 1.0
+    # Bildirishnomalar navbati (bazada saqlanadi, workerlar fonda yuboradi)
+    notification_workers: int = 4
+    notification_batch_size: int = 100
+    notification_poll_interval: float = 1.0
+    notification_max_attempts: int = 5
+    notification_backoff_base: float = 1.0
+    notification_backoff_max: float = 60.0
+    notification_lease: float = 300.0  # "sending" holatida qolib ketgan yozuvlar qayta olinadi
 
     @property
     def sponsor_channels_list(self) -> List[str]:
@@ -66,12 +122,62 @@ class Config(BaseSettings):
 
 settings = Config()
 
+# ==================== LOGGING ====================
+class JsonFormatter(logging.Formatter):
+    """Bir qatorli JSON log (Railway loglarini filtrlash uchun qulay)"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Loglarni navbat orqali alohida oqimda yozish.
+
+    Event loop faqat yozuvni navbatga qo'yadi, konsol va faylga yozishni
+    QueueListener oqimi bajaradi. Qaytarilgan listener to'xtatilishi kerak.
+    """
+    use_json = settings.is_railway if settings.log_json is None else settings.log_json
+    formatter = JsonFormatter() if use_json else logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    handlers = [logging.StreamHandler()]
+    if settings.log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            settings.log_file,
+            maxBytes=settings.log_file_max_bytes,
+            backupCount=settings.log_file_backup_count,
+            encoding="utf-8",
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(settings.log_level.upper())
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
 # ==================== DATABASE ====================
 class Base(DeclarativeBase):
     pass
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_created_at", "created_at"),
+        # Broadcast keyset so'rovi faqat yetib boriladigan foydalanuvchilarni o'qiydi
+        Index("ix_users_reachable_id", "is_reachable", "id"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True)
     telegram_id: Mapped[int] = mapped_column(BigInteger, unique=True, index=True)
@@ -82,9 +188,16 @@ class User(Base):
     referred_by: Mapped[int] = mapped_column(BigInteger, nullable=True)
     is_admin: Mapped[bool] = mapped_column(Boolean, default=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Botni bloklagan yoki akkauntini o'chirgan foydalanuvchilar broadcastda o'tkazib yuboriladi
+    is_reachable: Mapped[bool] = mapped_column(Boolean, default=True, server_default=true())
+    blocked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
 
 class Withdrawal(Base):
     __tablename__ = "withdrawals"
+    __table_args__ = (
+        Index("ix_withdrawals_user_id", "user_id"),
+        Index("ix_withdrawals_status_id", "status", "id"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(BigInteger)
@@ -95,6 +208,11 @@ class Withdrawal(Base):
 
 class Referral(Base):
     __tablename__ = "referrals"
+    __table_args__ = (
+        # referrer_id bo'yicha qidiruvlar ham shu indeksning chap qismidan foydalanadi
+        Index("uq_referrals_referrer_referred", "referrer_id", "referred_id", unique=True),
+        Index("ix_referrals_referred_reward", "referred_id", "reward_given"),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True)
     referrer_id: Mapped[int] = mapped_column(BigInteger)
@@ -102,57 +220,431 @@ class Referral(Base):
     reward_given: Mapped[bool] = mapped_column(Boolean, default=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+class SponsorChannel(Base):
+    __tablename__ = "sponsor_channels"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    username: Mapped[str] = mapped_column(String(255), unique=True)  # @kanal_nomi
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class LedgerEntry(Base):
+    __tablename__ = "ledger_entries"
+    __table_args__ = (
+        Index("ix_ledger_entries_user_id", "user_id", "id"),
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(BigInteger)  # telegram_id
+    delta: Mapped[int] = mapped_column(Integer)  # Stars (+ kirim, - chiqim)
+    reason: Mapped[str] = mapped_column(String(32))
+    ref_id: Mapped[int] = mapped_column(BigInteger, nullable=True)  # Referral yoki Withdrawal id
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class Counter(Base):
+    """Oshib boruvchi umumiy hisoblagichlar (statistika uchun O(1) o'qish)"""
+    __tablename__ = "counters"
+    
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    value: Mapped[int] = mapped_column(BigInteger, default=0)
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(String(20))  # text yoki forward
+    text: Mapped[str] = mapped_column(Text, nullable=True)
+    from_chat_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    status: Mapped[str] = mapped_column(String(20), default="running")  # running, paused, cancelled, done
+    # Qaysi replika yuboryapti - faqat lease (heartbeat_at) eskirganda boshqasi oladi
+    owner: Mapped[str] = mapped_column(String(100), nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0)  # Yetkazilgan oxirgi users.id
+    success_count: Mapped[int] = mapped_column(Integer, default=0)
+    error_count: Mapped[int] = mapped_column(Integer, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class JobLease(Base):
+    """Bir nechta replikadan faqat bittasida bajariladigan fon vazifalari"""
+    __tablename__ = "job_leases"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String(50), unique=True)
+    owner: Mapped[str] = mapped_column(String(100), nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+class Notification(Base):
+    """Yuborilishi kerak bo'lgan xabarlar navbati (outbox)"""
+    __tablename__ = "notifications"
+    __table_args__ = (
+        Index("ix_notifications_status_id", "status", "id"),
+    )
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    text: Mapped[str] = mapped_column(Text)
+    reply_markup: Mapped[str] = mapped_column(Text, nullable=True)  # InlineKeyboardMarkup JSON
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending, sending, dead, failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+    claimed_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
 # ==================== INIT ====================
 engine = create_async_engine(settings.database_url)
 async_session_maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Unique indeks uchun dublikatlar o'chirilganda qaysi qator qolishi:
+# avval shu ustunlar rost bo'lgani (mukofot berilgan referal), keyin eng kichik id
+DEDUPE_KEEP_FIRST = {"referrals": ("reward_given",)}
+
+def dedupe_for_unique_index(sync_conn, table, index) -> List[int]:
+    """Unique indeks yaratishdan oldin dublikatlarni o'chirish, o'chirilgan id larni qaytaradi"""
+    columns = [table.c[column.name] for column in index.columns]
+    order_by = [case((table.c[name] == True, 1), else_=0).desc() for name in DEDUPE_KEEP_FIRST.get(table.name, ())]
+    ranked = select(
+        table.c.id,
+        func.row_number().over(partition_by=columns, order_by=order_by + [table.c.id]).label("rank"),
+    ).subquery()
+    duplicate_ids = sync_conn.execute(
+        select(ranked.c.id).where(ranked.c.rank > 1).order_by(ranked.c.id)
+    ).scalars().all()
+    if duplicate_ids:
+        sync_conn.execute(delete(table).where(table.c.id.in_(duplicate_ids)))
+        logger.warning(
+            "Migration: removed %s duplicate rows from %s before creating %s, ids: %s",
+            len(duplicate_ids), table.name, index.name, duplicate_ids,
+        )
+    return duplicate_ids
+
+def migrate_db(sync_conn):
+    """Mavjud jadvallarga yetishmayotgan ustun va indekslarni qo'shish.
+
+    create_all faqat yangi jadvallarni yaratadi, eski SQLite/Postgres
+    bazalardagi jadvallar o'zgarmaydi - shuning uchun farqni shu yerda to'ldiramiz.
+    """
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                ddl = CreateColumn(column).compile(dialect=sync_conn.dialect)
+                sync_conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+                logger.info("Migration: added column %s.%s", table.name, column.name)
+        
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if index.unique:
+                # Dublikatlar bo'lsa unique indeks yaratilmaydi
+                dedupe_for_unique_index(sync_conn, table, index)
+            index.create(sync_conn)
+            logger.info("Migration: created index %s", index.name)
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_db)
+
+# ==================== LEDGER ====================
+REASON_REFERRAL_REWARD = "referral_reward"
+REASON_REFERRAL_PENALTY = "referral_penalty"
+REASON_WITHDRAWAL = "withdrawal"
+REASON_WITHDRAWAL_REFUND = "withdrawal_refund"
+REASON_ADMIN_ADJUST = "admin_adjust"
+
+# sabab -> (hisoblagich, ishora): hisoblagich += ishora * delta
+LEDGER_COUNTERS = {
+    REASON_REFERRAL_REWARD: ("total_issued", 1),
+    REASON_ADMIN_ADJUST: ("total_issued", 1),
+    REASON_REFERRAL_PENALTY: ("total_penalties", -1),
+    REASON_WITHDRAWAL: ("total_withdrawn", -1),
+    REASON_WITHDRAWAL_REFUND: ("total_withdrawn", -1),
+}
+
+def dialect_insert(model):
+    """Bazaga mos INSERT (ON CONFLICT qo'llab-quvvatlaydigan)"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+COUNTER_DELTAS_KEY = "counter_deltas"
+
+async def bump_counter(session, name: str, delta: int):
+    """Hisoblagich o'zgarishini tranzaksiya oxirigacha yig'ish.
+
+    Barcha o'zgarishlar commitdan oldin nom bo'yicha tartiblab yoziladi: Counter
+    qatorlari har doim foydalanuvchi/ariza qatorlaridan keyin va bir xil
+    tartibda qulflanadi, shuning uchun Postgresda deadlock bo'lmaydi.
+    """
+    if not delta:
+        return
+    deltas = session.info.setdefault(COUNTER_DELTAS_KEY, {})
+    deltas[name] = deltas.get(name, 0) + delta
+
+@listens_for(Session, "before_commit")
+def _flush_counter_deltas(session):
+    deltas = session.info.pop(COUNTER_DELTAS_KEY, None) or {}
+    for name in sorted(deltas):
+        delta = deltas[name]
+        if not delta:
+            continue
+        stmt = dialect_insert(Counter).values(name=name, value=delta)
+        session.execute(stmt.on_conflict_do_update(index_elements=[Counter.name], set_={"value": Counter.value + delta}))
+
+@listens_for(Session, "after_soft_rollback")
+def _drop_counter_deltas(session, previous_transaction):
+    session.info.pop(COUNTER_DELTAS_KEY, None)
+
+async def get_counters(session, *names: str) -> Dict[str, int]:
+    result = await session.execute(select(Counter.name, Counter.value).where(Counter.name.in_(names)))
+    counters = dict.fromkeys(names, 0)
+    counters.update(result.tuples().all())
+    return counters
+
+async def change_balance(session, telegram_id: int, delta: int, reason: str,
+                         ref_id: Optional[int] = None, referral_delta: int = 0):
+    """Balansni bitta atomar UPDATE ... RETURNING bilan o'zgartirish.
+
+    Ayirishda `balance >= summa` sharti qo'yiladi. Ledger yozuvi va
+    hisoblagichlar shu tranzaksiyada yoziladi. Foydalanuvchi topilmasa
+    yoki balans yetarli bo'lmasa None qaytaradi. Commit chaqiruvchida.
+    """
+    stmt = update(User).where(User.telegram_id == telegram_id)
+    if delta < 0:
+        stmt = stmt.where(User.balance >= -delta)
+    values = {"balance": User.balance + delta}
+    if referral_delta:
+        new_count = User.referral_count + referral_delta
+        values["referral_count"] = case((new_count < 0, 0), else_=new_count)
+    result = await session.execute(
+        stmt.values(**values)
+        .returning(User.telegram_id, User.balance, User.referral_count, User.username, User.first_name)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.one_or_none()
+    if row is None:
+        return None
+    
+    session.add(LedgerEntry(user_id=telegram_id, delta=delta, reason=reason, ref_id=ref_id))
+    counter_name, sign = LEDGER_COUNTERS[reason]
+    await bump_counter(session, counter_name, sign * delta)
+    await bump_counter(session, STAT_BALANCE_TOTAL, delta)
+    return row
+
+async def settle_referrals(session, claimed: Sequence[Any], amount: int, reason: str):
+    """Band qilingan referallar bo'yicha referrerlar balansini bitta UPDATE bilan o'zgartirish.
+
+    `claimed` - (id, referrer_id, ...) qatorlari, reward_given allaqachon
+    o'zgartirilgan. Ayirishda balansi yetmagan yoki topilmagan referrerlarning
+    referallari avvalgi holatiga qaytariladi. (referral, referrer) juftlarini qaytaradi.
+    """
+    counts: Dict[int, int] = {}
+    for referral in claimed:
+        counts[referral.referrer_id] = counts.get(referral.referrer_id, 0) + 1
+    delta = case({user_id: count * amount for user_id, count in counts.items()}, value=User.telegram_id)
+    new_count = User.referral_count + case(
+        {user_id: count if amount > 0 else -count for user_id, count in counts.items()}, value=User.telegram_id
+    )
+    stmt = update(User).where(User.telegram_id.in_(counts))
+    if amount < 0:
+        stmt = stmt.where(User.balance + delta >= 0)
+    result = await session.execute(
+        stmt.values(balance=User.balance + delta, referral_count=case((new_count < 0, 0), else_=new_count))
+        .returning(User.telegram_id, User.balance, User.referral_count, User.username)
+        .execution_options(synchronize_session=False)
+    )
+    referrers = {row.telegram_id: row for row in result}
+    
+    released = [referral.id for referral in claimed if referral.referrer_id not in referrers]
+    if released:
+        await session.execute(
+            update(Referral).where(Referral.id.in_(released)).values(reward_given=amount < 0)
+            .execution_options(synchronize_session=False)
+        )
+    settled = [referral for referral in claimed if referral.referrer_id in referrers]
+    if settled:
+        await session.execute(insert(LedgerEntry), [
+            {"user_id": referral.referrer_id, "delta": amount, "reason": reason, "ref_id": referral.id}
+            for referral in settled
+        ])
+        total = amount * len(settled)
+        counter_name, sign = LEDGER_COUNTERS[reason]
+        await bump_counter(session, counter_name, sign * total)
+        await bump_counter(session, STAT_BALANCE_TOTAL, total)
+        await bump_counter(session, STAT_REFERRALS_REWARDED, len(settled) if amount > 0 else -len(settled))
+    return [(referral, referrers[referral.referrer_id]) for referral in settled]
+
+# ==================== STATS ====================
+# Har bir o'zgarish bilan bir tranzaksiyada yangilanadigan hisoblagichlar
+STAT_USERS_TOTAL = "users_total"
+STAT_BALANCE_TOTAL = "balance_total"
+STAT_WITHDRAWALS_PENDING = "withdrawals_pending"
+STAT_REFERRALS_REWARDED = "referrals_rewarded"
+STAT_USERS_UNREACHABLE = "users_unreachable"
+
+def signups_counter(day: datetime) -> str:
+    return f"signups:{day:%Y-%m-%d}"
+
+async def record_signup(session, created_at: datetime):
+    await bump_counter(session, STAT_USERS_TOTAL, 1)
+    await bump_counter(session, signups_counter(created_at), 1)
+
+async def set_counter(session, name: str, value: int):
+    stmt = dialect_insert(Counter).values(name=name, value=value)
+    await session.execute(stmt.on_conflict_do_update(index_elements=[Counter.name], set_={"value": value}))
+
+async def recompute_stats():
+    """Hisoblagichlarni jadvallardan to'liq qayta hisoblash (drift tuzatish)"""
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    async with async_session_maker() as session:
+        users_total, balance_total = (await session.execute(
+            select(func.count(User.id), func.coalesce(func.sum(User.balance), 0))
+        )).one()
+        withdrawals_pending = (await session.execute(
+            select(func.count(Withdrawal.id)).where(Withdrawal.status == WITHDRAWAL_PENDING)
+        )).scalar()
+        referrals_rewarded = (await session.execute(
+            select(func.count(Referral.id)).where(Referral.reward_given == True)
+        )).scalar()
+        users_unreachable = (await session.execute(
+            select(func.count(User.id)).where(User.is_reachable == False)
+        )).scalar()
+        # Bugungi ro'yxatdan o'tishlar created_at indeksi bo'yicha
+        signups_today = (await session.execute(
+            select(func.count(User.id)).where(User.created_at >= today)
+        )).scalar()
+        
+        values = {
+            STAT_USERS_TOTAL: users_total,
+            STAT_BALANCE_TOTAL: balance_total,
+            STAT_WITHDRAWALS_PENDING: withdrawals_pending,
+            STAT_REFERRALS_REWARDED: referrals_rewarded,
+            STAT_USERS_UNREACHABLE: users_unreachable,
+            signups_counter(today): signups_today,
+        }
+        for name, value in values.items():
+            await set_counter(session, name, value)
+        await session.commit()
+    logger.info("Stats recomputed: %s", values)
+    return values
+
+async def stats_recompute_loop(interval: float):
+    while True:
+        try:
+            await recompute_stats()
+        except Exception as e:
+            logger.error("Stats recompute failed: %s", e)
+        await asyncio.sleep(interval)
 
 # ==================== KEYBOARDS ====================
+# Klaviaturalar bir marta yaratiladi: aiogram ularni o'zgartirmaydi, faqat serializatsiya qiladi
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="⭐ Balans"), KeyboardButton(text="👥 Referallar")],
+        [KeyboardButton(text="🔗 Referal havola"), KeyboardButton(text="⭐ Stars yechib olish")],
+        [KeyboardButton(text="📞 Admin bilan aloqa")]
+    ],
+    resize_keyboard=True
+)
+
+ADMIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="👥 Foydalanuvchilar"), KeyboardButton(text="⭐ Balansni o'zgartirish")],
+        [KeyboardButton(text="📊 Statistika"), KeyboardButton(text="⚙️ Sozlamalar")],
+        [KeyboardButton(text="📢 Xabar yuborish"), KeyboardButton(text="📺 Homiy kanallar")]
+    ],
+    resize_keyboard=True
+)
+
 def main_menu():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="⭐ Balans"), KeyboardButton(text="👥 Referallar")],
-            [KeyboardButton(text="🔗 Referal havola"), KeyboardButton(text="⭐ Stars yechib olish")],
-            [KeyboardButton(text="📞 Admin bilan aloqa")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+    return MAIN_MENU_KEYBOARD
 
-def restricted_menu():
-    channels = settings.sponsor_channels_list
-    print(f"DEBUG: restricted_menu channels: {channels}")
+def channel_url(channel: str) -> str:
+    return f"https://t.me/{channel.lstrip('@')}"
+
+@lru_cache(maxsize=8)
+def _restricted_menu(channels: Tuple[str, ...]) -> InlineKeyboardMarkup:
+    # Kesh kaliti - kanallar ro'yxati, u o'zgarsa yangi klaviatura quriladi
+    logger.debug("restricted_menu built for channels: %s", channels)
     
     if channels:
-        channel_buttons = []
-        for channel in channels:
-            channel_url = f"https://t.me/{channel.lstrip('@')}"
-            channel_buttons.append([InlineKeyboardButton(text=f"📺 {channel}", url=channel_url)])
-        
+        channel_buttons = [
+            [InlineKeyboardButton(text=f"📺 {channel}", url=channel_url(channel))]
+            for channel in channels
+        ]
         channel_buttons.append([InlineKeyboardButton(text=" Obunani tekshirish 🔍", callback_data="check_subscription")])
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=channel_buttons)
-    else:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=" Obuna bo'lish ✅", url="#")],
-            [InlineKeyboardButton(text=" Obunani tekshirish 🔍", callback_data="check_subscription")]
-        ])
+        return InlineKeyboardMarkup(inline_keyboard=channel_buttons)
     
-    return keyboard
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=" Obuna bo'lish ✅", url="#")],
+        [InlineKeyboardButton(text=" Obunani tekshirish 🔍", callback_data="check_subscription")]
+    ])
+
+def restricted_menu():
+    return _restricted_menu(channel_store.channels)
+
+@lru_cache(maxsize=64)
+def subscription_status_keyboard(unsubscribed: Tuple[str, ...], subscribed: Tuple[str, ...],
+                                 unknown: Tuple[str, ...] = ()) -> InlineKeyboardMarkup:
+    channel_buttons = [[InlineKeyboardButton(text=f"❌ {channel}", url=channel_url(channel))] for channel in unsubscribed]
+    channel_buttons += [[InlineKeyboardButton(text=f"⏳ {channel}", url=channel_url(channel))] for channel in unknown]
+    channel_buttons += [[InlineKeyboardButton(text=f"✅ {channel}", url=channel_url(channel))] for channel in subscribed]
+    channel_buttons.append([InlineKeyboardButton(text="🔄 Obunani qayta tekshirish", callback_data="check_subscription")])
+    return InlineKeyboardMarkup(inline_keyboard=channel_buttons)
 
 def admin_menu():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👥 Foydalanuvchilar"), KeyboardButton(text="⭐ Balansni o'zgartirish")],
-            [KeyboardButton(text="📊 Statistika"), KeyboardButton(text="⚙️ Sozlamalar")],
-            [KeyboardButton(text="📢 Xabar yuborish"), KeyboardButton(text="📺 Homiy kanallar")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+    return ADMIN_MENU_KEYBOARD
+
+# ==================== TEXTS ====================
+SUBSCRIBE_REQUIRED_TEXT = (
+    "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
+    "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi."
+)
+
+SUBSCRIPTION_INCOMPLETE_TEMPLATE = (
+    "❌ Obuna to'liq emas!\n\n"
+    "📊 Jami kanallar: {total} ta\n"
+    "✅ Obuna bo'lgan: {subscribed} ta\n"
+    "❌ Obuna bo'lmagan: {unsubscribed} ta\n\n"
+    "🔽 Obuna bo'lmagan kanallar:\n"
+    "{channels}\n"
+    "\n📱 Quyi tugmalarni bosib obuna bo'ling!\n\n"
+    "⚠️ Diqqat: Obuna bo'lmaganingiz uchun:\n"
+    "• Referallaringizdan bonuslar olinmaydi\n"
+    "• Stars yechib olish imkonsiz\n"
+    "• Botning barcha funktsiyalari cheklangan\n\n"
+    "🔄 Obuna bo'lgandan so'ng 'Obunani qayta tekshirish' tugmasini bosing!"
+)
+
+SUBSCRIPTION_UNKNOWN_TEMPLATE = (
+    "⏳ Obunani tekshirib bo'lmadi!\n\n"
+    "📊 Jami kanallar: {total} ta\n"
+    "✅ Obuna bo'lgan: {subscribed} ta\n"
+    "⏳ Javob olinmagan: {unknown} ta\n\n"
+    "🔽 Tekshirilmagan kanallar:\n"
+    "{channels}\n\n"
+    "🔄 Birozdan so'ng 'Obunani qayta tekshirish' tugmasini bosing!"
+)
+
+SUBSCRIPTION_COMPLETE_TEMPLATE = (
+    "🎉 TABRIKLAYMIZ!\n\n"
+    "✅ Siz barcha {total} ta kanalga obuna bo'ldingiz!\n"
+    "🚀 Endi botning barcha imkoniyatlaridan foydalanishingiz mumkin:\n\n"
+    "⭐ Balangizni ko'rish\n"
+    "👥 Referallaringizni ko'rish\n"
+    "🔗 Referal havola olish\n"
+    "⭐ Stars yechib olish\n\n"
+    "🔗 Sizning referal havolangiz:\n{referral_link}"
+)
 
 def format_balance(amount: int) -> str:
     return f"{amount:,}".replace(",", " ")
@@ -160,109 +652,1334 @@ def format_balance(amount: int) -> str:
 def generate_referral_link(user_id: int, bot_username: str) -> str:
     return f"https://t.me/{bot_username}?start={user_id}"
 
+class BotIdentity:
+    """get_me natijasi: main() da bir marta olinadi, handlerlarga workflow data orqali beriladi"""
+
+    def __init__(self):
+        self.me: Optional[types.User] = None
+
+    @property
+    def username(self) -> str:
+        return self.me.username if self.me else ""
+
+    async def refresh(self, bot: Bot) -> types.User:
+        self.me = await bot.get_me()
+        logger.info("Bot identity loaded: @%s (%s)", self.me.username, self.me.id)
+        return self.me
+
+bot_identity = BotIdentity()
+
+# ==================== SUBSCRIPTION CACHE ====================
+class SubscriptionCache:
+    """(user_id, kanal) bo'yicha a'zolik natijalarini TTL va LRU bilan saqlash"""
+
+    def __init__(self, positive_ttl: float, negative_ttl: float, max_size: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[int, str], Tuple[bool, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int, channel: str) -> Optional[bool]:
+        key = (user_id, channel)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        is_member, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return is_member
+
+    def set(self, user_id: int, channel: str, is_member: bool):
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        if ttl <= 0:
+            return
+        key = (user_id, channel)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int, channels: Iterable[str]):
+        for channel in channels:
+            self._entries.pop((user_id, channel), None)
+
+    def clear(self):
+        self._entries.clear()
+
+subscription_cache = SubscriptionCache(
+    settings.subscription_cache_ttl,
+    settings.subscription_cache_negative_ttl,
+    settings.subscription_cache_size,
+)
+
+# ==================== SPONSOR CHANNELS ====================
+CHANNELS_VERSION_COUNTER = "sponsor_channels_version"
+
+class ChannelStore:
+    """Homiy kanallar bazada saqlanadi, jarayonda esa tayyor tuple sifatida turadi.
+
+    Har bir o'zgarish versiya hisoblagichini oshiradi. Replikalar faqat
+    versiyani (bitta qator) so'rab turadi va u o'zgarganda ro'yxatni qayta o'qiydi.
+    """
+
+    def __init__(self):
+        self.channels: Tuple[str, ...] = ()
+        self.version: Optional[int] = None
+
+    async def _load(self, session, version: int):
+        result = await session.execute(select(SponsorChannel.username).order_by(SponsorChannel.id))
+        channels = tuple(result.scalars().all())
+        if channels != self.channels:
+            subscription_cache.clear()
+        self.channels = channels
+        self.version = version
+        logger.info("Sponsor channels loaded (v%s): %s", version, channels)
+
+    async def _read_version(self, session) -> Optional[int]:
+        result = await session.execute(select(Counter.value).where(Counter.name == CHANNELS_VERSION_COUNTER))
+        return result.scalar_one_or_none()
+
+    async def init(self, default_channels: List[str]):
+        """Birinchi ishga tushishda SPONSOR_CHANNELS dan boshlang'ich ro'yxatni yozish"""
+        async with async_session_maker() as session:
+            version = await self._read_version(session)
+            if version is None:
+                for channel in default_channels:
+                    await session.execute(
+                        dialect_insert(SponsorChannel).values(username=channel).on_conflict_do_nothing()
+                    )
+                await bump_counter(session, CHANNELS_VERSION_COUNTER, 1)
+                await session.commit()
+                version = await self._read_version(session)
+            await self._load(session, version)
+
+    async def refresh_if_changed(self) -> bool:
+        async with async_session_maker() as session:
+            version = await self._read_version(session)
+            if version is None or version == self.version:
+                return False
+            await self._load(session, version)
+            return True
+
+    async def poll(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_if_changed()
+            except Exception as e:
+                logger.error("Sponsor channels refresh failed: %s", e)
+
+    async def _change(self, statement) -> bool:
+        async with async_session_maker() as session:
+            try:
+                result = await session.execute(statement)
+            except IntegrityError:
+                await session.rollback()
+                return False
+            if not result.rowcount:
+                await session.rollback()
+                return False
+            await bump_counter(session, CHANNELS_VERSION_COUNTER, 1)
+            await session.commit()
+            await self._load(session, await self._read_version(session))
+        return True
+
+    async def add(self, channel: str) -> bool:
+        return await self._change(dialect_insert(SponsorChannel).values(username=channel).on_conflict_do_nothing())
+
+    async def remove(self, channel: str) -> bool:
+        return await self._change(delete(SponsorChannel).where(SponsorChannel.username == channel))
+
+    async def clear(self) -> bool:
+        return await self._change(delete(SponsorChannel))
+
+channel_store = ChannelStore()
+
+NOT_SUBSCRIBED_STATUSES = ('left', 'kicked', 'banned')
+
+async def _fetch_channel_status(user_id: int, channel: str, bot: Bot, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        member = await bot.get_chat_member(channel, user_id)
+    logger.debug("User %s status in %s: %s", user_id, channel, member.status)
+    is_member = member.status not in NOT_SUBSCRIBED_STATUSES
+    subscription_cache.set(user_id, channel, is_member)
+    return is_member
+
+async def get_subscription_statuses(user_id: int, bot: Bot, channels: Sequence[str],
+                                    stop_on_first_failure: bool = True) -> Dict[str, Optional[bool]]:
+    """Kanallarni parallel tekshirish (umumiy deadline bilan).
+
+    Xato yoki timeout bo'lgan kanallar None (noma'lum) bo'ladi - ular kirish
+    uchun obuna hisoblanmaydi, lekin jarima uchun chiqib ketgan ham emas.
+    """
+    statuses: Dict[str, Optional[bool]] = {}
+    to_fetch = []
+    for channel in channels:
+        cached = subscription_cache.get(user_id, channel)
+        if cached is None:
+            to_fetch.append(channel)
+            continue
+        statuses[channel] = cached
+        if not cached and stop_on_first_failure:
+            return statuses
+    
+    if not to_fetch:
+        return statuses
+    
+    # Railwayda ham obuna tekshirish kerak, lekin timeout ni oshiramiz
+    timeout = 10.0 if settings.is_railway else 5.0
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    semaphore = asyncio.Semaphore(settings.subscription_check_concurrency)
+    tasks = {
+        asyncio.create_task(_fetch_channel_status(user_id, channel, bot, semaphore)): channel
+        for channel in to_fetch
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                channel = tasks[task]
+                try:
+                    is_member = task.result()
+                except Exception as e:
+                    logger.debug("Error checking %s for user %s: %s", channel, user_id, e)
+                    is_member = None
+                statuses[channel] = is_member
+                if not is_member and stop_on_first_failure:
+                    return statuses
+        for task in pending:
+            logger.debug("Timeout checking %s for user %s", tasks[task], user_id)
+            statuses[tasks[task]] = None
+    finally:
+        for task in pending:
+            task.cancel()
+    return statuses
+
+_subscription_checks_inflight: Dict[int, asyncio.Task] = {}
+
 async def check_subscription(user_id: int, bot: Bot) -> bool:
-    channels = settings.sponsor_channels_list
-    print(f"DEBUG: Checking subscription for user {user_id} in channels: {channels}")
+    """Bir foydalanuvchi uchun bir vaqtdagi tekshiruvlar bitta umumiy natijani kutadi"""
+    task = _subscription_checks_inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_check_subscription(user_id, bot))
+        _subscription_checks_inflight[user_id] = task
+        task.add_done_callback(lambda _: _subscription_checks_inflight.pop(user_id, None))
+    else:
+        logger.debug("Joining in-flight subscription check for user %s", user_id)
+    # Bitta chaqiruvchi bekor qilinsa ham umumiy tekshiruv davom etadi
+    return await asyncio.shield(task)
+
+async def _check_subscription(user_id: int, bot: Bot) -> bool:
+    channels = channel_store.channels
+    logger.debug("Checking subscription for user %s in channels: %s", user_id, channels)
     
     if not channels:
-        print("DEBUG: No sponsor channels configured, returning True")
+        logger.debug("No sponsor channels configured, returning True")
         return True
     
-    if settings.is_railway:
-        print("DEBUG: Railway mode enabled, but still checking subscription")
-        # Railwayda ham obuna tekshirish kerak, lekin timeout ni oshiramiz
-        timeout = 10.0
-    else:
-        timeout = 5.0
+    statuses = await get_subscription_statuses(user_id, bot, channels)
+    if not all(statuses.get(channel) for channel in channels):
+        logger.debug("User %s not subscribed to all channels", user_id)
+        return False
     
-    for channel in channels:
+    logger.debug("User %s subscribed to all channels", user_id)
+    return True
+
+# ==================== BROADCAST ====================
+_background_tasks = set()
+
+def spawn_background(coro) -> asyncio.Task:
+    """Fon vazifasini ishga tushirish (GC yo'qotib qo'ymasligi uchun havolani saqlaymiz)"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+class TokenBucket:
+    """Sekundiga `rate` ta token, `capacity` tagacha to'planadi"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block(self, seconds: float):
+        """RetryAfter kelganda barcha yuboruvchilarni to'xtatib turish"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class TelegramRateLimiter:
+    """Umumiy (global) va har bir chat uchun alohida limit"""
+
+    def __init__(self, global_rate: float, per_chat_interval: float):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self._next_slot: "OrderedDict[int, float]" = OrderedDict()
+
+    def block(self, seconds: float):
+        self.bucket.block(seconds)
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        # Eskirgan yozuvlarni tozalash - xotira chegaralangan bo'lib qoladi
+        while self._next_slot:
+            oldest_chat, slot = next(iter(self._next_slot.items()))
+            if slot > now:
+                break
+            del self._next_slot[oldest_chat]
+        slot = max(now, self._next_slot.get(chat_id, now))
+        self._next_slot[chat_id] = slot + self.per_chat_interval
+        self._next_slot.move_to_end(chat_id)
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+
+telegram_limiter = TelegramRateLimiter(settings.broadcast_rate_limit, settings.per_chat_interval)
+
+async def iter_user_ids(batch_size: int, after_id: int = 0):
+    """Yetib boriladigan foydalanuvchilarni (id, telegram_id) ko'rinishida keyset sahifalash bilan o'qish.
+
+    Har bir sahifa alohida qisqa sessiyada o'qiladi, shuning uchun xotira
+    foydalanuvchilar soniga bog'liq emas. Botni bloklaganlar
+    ix_users_reachable_id indeksi orqali o'tkazib yuboriladi.
+    """
+    last_id = after_id
+    while True:
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(User.id, User.telegram_id)
+                .where(User.is_reachable == True, User.id > last_id)
+                .order_by(User.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+        for row in rows:
+            yield row.id, row.telegram_id
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+# Har bir jarayon uchun noyob - broadcast va fon vazifalari lease egasi
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+async def acquire_job_lease(name: str, ttl: float) -> bool:
+    """Lease ni olish yoki yangilash (shartli UPDATE).
+
+    Egasi har doim yangilay oladi, boshqa replika faqat heartbeat `ttl`
+    sekunddan eski bo'lsa oladi.
+    """
+    now = datetime.utcnow()
+    async with async_session_maker() as session:
+        await session.execute(
+            dialect_insert(JobLease).values(name=name).on_conflict_do_nothing(index_elements=[JobLease.name])
+        )
+        result = await session.execute(
+            update(JobLease)
+            .where(
+                JobLease.name == name,
+                or_(
+                    JobLease.owner == INSTANCE_ID,
+                    JobLease.owner.is_(None),
+                    JobLease.heartbeat_at.is_(None),
+                    JobLease.heartbeat_at < now - timedelta(seconds=ttl),
+                ),
+            )
+            .values(owner=INSTANCE_ID, heartbeat_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    return bool(result.rowcount)
+
+async def run_leased(name: str, interval: float, job: Callable[[Callable[[], Awaitable[bool]]], Awaitable[Any]]):
+    """Har `interval` da `job(renew)` ni faqat lease egasi bo'lgan replikada bajarish.
+
+    Lease tugagandan keyin ham egasida qoladi, shuning uchun replikalar soni
+    qancha bo'lmasin vazifa bir intervalda bir marta bajariladi. Uzoq
+    vazifa har bir bosqichda renew() chaqiradi va False bo'lsa to'xtaydi.
+    """
+    ttl = interval + settings.background_lease
+    
+    def renew() -> Awaitable[bool]:
+        return acquire_job_lease(name, ttl)
+    
+    while True:
+        await asyncio.sleep(interval)
         try:
-            print(f"DEBUG: Checking channel {channel} for user {user_id}")
-            member = await asyncio.wait_for(
-                bot.get_chat_member(channel, user_id), 
-                timeout=timeout
+            if await renew():
+                await job(renew)
+        except Exception as e:
+            logger.error("Background job %s failed: %s", name, e)
+
+BROADCAST_STATUS_LABELS = {
+    "running": "⏳ Yuborilmoqda",
+    "paused": "⏸ To'xtatilgan",
+    "cancelled": "🚫 Bekor qilingan",
+    "done": "✅ Yakunlangan",
+}
+
+class BroadcastJob:
+    """Bazada saqlanadigan, to'xtatib/davom ettirib bo'ladigan broadcast.
+
+    Kursor (last_user_id) faqat undan oldingi barcha foydalanuvchilarga
+    yuborish tugagandan keyin suriladi, shuning uchun qayta ishga
+    tushganda yetkazilgan foydalanuvchilarga xabar qayta yuborilmaydi.
+    """
+
+    def __init__(self, bot: Bot, broadcast: Broadcast):
+        self.bot = bot
+        self.id = broadcast.id
+        self.kind = broadcast.kind
+        self.text = broadcast.text
+        self.from_chat_id = broadcast.from_chat_id
+        self.message_id = broadcast.message_id
+        self.admin_chat_id = broadcast.admin_chat_id
+        self.progress_message_id = broadcast.progress_message_id
+        self.last_user_id = broadcast.last_user_id
+        self.success_count = broadcast.success_count
+        self.error_count = broadcast.error_count
+        self.total = broadcast.total
+        self.status = "running"
+        self.lost = False  # Lease boshqa replikaga o'tdi
+        self._dispatched: deque = deque()
+        self._delivered = set()
+        self._unreachable: List[int] = []
+
+    @property
+    def title(self) -> str:
+        return "Forward xabar" if self.kind == "forward" else "Xabar"
+
+    def stop(self, status: str):
+        """Pauza yoki bekor qilish - navbatdagilar yuborilmaydi"""
+        if self.status == "running":
+            self.status = status
+
+    def progress_text(self) -> str:
+        if self.status == "done":
+            header = f"✅ {self.title} yuborildi!"
+        elif self.status == "running":
+            header = f"📢 {self.title} yuborilmoqda..."
+        else:
+            header = f"{BROADCAST_STATUS_LABELS[self.status]}: {self.title}"
+        return (
+            f"{header}\n\n"
+            f"🆔 Broadcast: #{self.id}\n"
+            f"📊 Muvaffaqiyatli: {self.success_count} ta\n"
+            f"❌ Xatolik: {self.error_count} ta\n"
+            f"👥 Jami: {self.total} ta foydalanuvchi"
+        )
+
+    async def send(self, chat_id: int):
+        if self.kind == "forward":
+            await self.bot.forward_message(
+                chat_id=chat_id, from_chat_id=self.from_chat_id, message_id=self.message_id
             )
-            print(f"DEBUG: User {user_id} status in {channel}: {member.status}")
-            if member.status in ['left', 'kicked', 'banned']:
-                print(f"DEBUG: User {user_id} not subscribed to {channel}")
-                return False
+        else:
+            await self.bot.send_message(chat_id, f"📢 ADMIN XABARI\n\n{self.text}")
+
+    async def _deliver(self, chat_id: int):
+        for attempt in range(settings.broadcast_max_retries + 1):
+            await telegram_limiter.acquire(chat_id)
+            try:
+                await self.send(chat_id)
+                self.success_count += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.info("Broadcast flood limit, %ss kutamiz", e.retry_after)
+                telegram_limiter.block(e.retry_after)
+            except Exception as e:
+                logger.debug("Broadcast error for %s: %s", chat_id, e)
+                if is_unreachable_error(e):
+                    # Keyingi checkpointda belgilanadi - keyingi broadcastlarda o'tkazib yuboriladi
+                    self._unreachable.append(chat_id)
+                break
+        self.error_count += 1
+
+    def _mark_delivered(self, user_row_id: int):
+        self._delivered.add(user_row_id)
+        while self._dispatched and self._dispatched[0] in self._delivered:
+            self.last_user_id = self._dispatched.popleft()
+            self._delivered.discard(self.last_user_id)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if self.status != "running":
+                # To'xtatilgan - kursor shu foydalanuvchidan oldin qoladi
+                continue
+            user_row_id, chat_id = item
+            await self._deliver(chat_id)
+            self._mark_delivered(user_row_id)
+
+    async def _checkpoint(self, status: Optional[str] = None):
+        """Kursor va heartbeat ni saqlash, bazadagi holatni qayta o'qish.
+
+        /bpause va /bcancel boshqa replikada bajarilgan bo'lishi mumkin - bazadagi
+        holat running bo'lmasa u saqlanadi va vazifa to'xtaydi. UPDATE faqat
+        lease egasi uchun ishlaydi.
+        """
+        now = datetime.utcnow()
+        values = dict(
+            last_user_id=self.last_user_id,
+            success_count=self.success_count,
+            error_count=self.error_count,
+            progress_message_id=self.progress_message_id,
+            updated_at=now,
+            heartbeat_at=now,
+        )
+        if status:
+            values["status"] = case((Broadcast.status == "running", status), else_=Broadcast.status)
+        unreachable, self._unreachable = self._unreachable, []
+        async with async_session_maker() as session:
+            result = await session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == self.id, Broadcast.owner == INSTANCE_ID)
+                .values(**values)
+                .returning(Broadcast.status)
+                .execution_options(synchronize_session=False)
+            )
+            current = result.scalar_one_or_none()
+            await mark_unreachable(session, unreachable)
+            await session.commit()
+        if current is None:
+            if not self.lost:
+                logger.warning("Broadcast #%s lease lost, stopping", self.id)
+            self.lost = True
+            self.stop("paused")
+        elif current != "running":
+            self.status = current
+
+    async def _edit_progress(self):
+        try:
+            await self.bot.edit_message_text(
+                self.progress_text(), chat_id=self.admin_chat_id, message_id=self.progress_message_id
+            )
+        except TelegramAPIError:
+            # "message is not modified" va shunga o'xshashlar - muhim emas
+            pass
+
+    async def _report_progress(self):
+        last_edit = last_heartbeat = time.monotonic()
+        while True:
+            await asyncio.sleep(settings.broadcast_checkpoint_interval)
+            try:
+                await self._checkpoint()
+                last_heartbeat = time.monotonic()
+            except Exception as e:
+                logger.error("Broadcast #%s checkpoint failed: %s", self.id, e)
+                # Lease eskirguncha to'xtaymiz - aks holda boshqa replika bilan ikki marta yuboriladi
+                if time.monotonic() - last_heartbeat >= settings.broadcast_lease / 2:
+                    self.lost = True
+                    self.stop("paused")
+                continue
+            if time.monotonic() - last_edit >= settings.broadcast_progress_interval:
+                last_edit = time.monotonic()
+                await self._edit_progress()
+
+    async def run(self):
+        progress = await self.bot.send_message(self.admin_chat_id, self.progress_text())
+        self.progress_message_id = progress.message_id
+        reporter = asyncio.create_task(self._report_progress())
+        queue: asyncio.Queue = asyncio.Queue(maxsize=settings.broadcast_concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(settings.broadcast_concurrency)]
+        try:
+            async for user_row_id, telegram_id in iter_user_ids(settings.broadcast_batch_size, self.last_user_id):
+                if self.status != "running":
+                    break
+                self._dispatched.append(user_row_id)
+                await queue.put((user_row_id, telegram_id))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+            active_broadcasts.pop(self.id, None)
+        if self.lost:
+            # Davom ettirish lease ni olgan replikada
+            return
+        if self.status == "running":
+            self.status = "done"
+        await self._checkpoint(self.status)
+        await self._edit_progress()
+        logger.info("Broadcast #%s %s: success=%s, errors=%s", self.id, self.status, self.success_count, self.error_count)
+
+active_broadcasts: Dict[int, BroadcastJob] = {}
+
+def run_broadcast_job(bot: Bot, broadcast: Broadcast) -> BroadcastJob:
+    job = BroadcastJob(bot, broadcast)
+    active_broadcasts[job.id] = job
+    spawn_background(job.run())
+    return job
+
+async def start_broadcast(bot: Bot, admin_chat_id: int, kind: str, text: Optional[str] = None,
+                          from_chat_id: Optional[int] = None, message_id: Optional[int] = None) -> BroadcastJob:
+    async with async_session_maker() as session:
+        total = (await session.execute(
+            select(func.count(User.id)).where(User.is_reachable == True)
+        )).scalar() or 0
+        broadcast = Broadcast(
+            kind=kind,
+            text=text,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+            admin_chat_id=admin_chat_id,
+            status="running",
+            total=total,
+            owner=INSTANCE_ID,
+            heartbeat_at=datetime.utcnow(),
+        )
+        session.add(broadcast)
+        await session.commit()
+    return run_broadcast_job(bot, broadcast)
+
+def _broadcast_lease_expired():
+    stale = datetime.utcnow() - timedelta(seconds=settings.broadcast_lease)
+    return or_(Broadcast.owner.is_(None), Broadcast.heartbeat_at.is_(None), Broadcast.heartbeat_at < stale)
+
+async def claim_broadcast(session, broadcast_id: int, include_paused: bool = False) -> Optional[Broadcast]:
+    """Broadcastni shartli UPDATE bilan shu replikaga olish.
+
+    Running holatidagisi faqat lease eskirgan bo'lsa olinadi, shuning uchun
+    ikki replika bir broadcastni parallel yubormaydi. Commit chaqiruvchida.
+    """
+    claimable = and_(Broadcast.status == "running", _broadcast_lease_expired())
+    if include_paused:
+        claimable = or_(Broadcast.status == "paused", claimable)
+    result = await session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id, claimable)
+        .values(status="running", owner=INSTANCE_ID, heartbeat_at=datetime.utcnow())
+        .returning(Broadcast)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )
+    return result.scalar_one_or_none()
+
+async def resume_broadcasts(bot: Bot):
+    """Egasi to'xtagan (lease eskirgan) broadcastlarni kursordan davom ettirish"""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(Broadcast.id).where(Broadcast.status == "running", _broadcast_lease_expired())
+        )
+        broadcast_ids = result.scalars().all()
+    for broadcast_id in broadcast_ids:
+        if broadcast_id in active_broadcasts:
+            continue
+        async with async_session_maker() as session:
+            broadcast = await claim_broadcast(session, broadcast_id)
+            await session.commit()
+        if broadcast:
+            logger.info("Resuming broadcast #%s from user id %s", broadcast.id, broadcast.last_user_id)
+            run_broadcast_job(bot, broadcast)
+
+async def broadcast_resume_loop(bot: Bot, interval: float):
+    while True:
+        try:
+            await resume_broadcasts(bot)
+        except Exception as e:
+            logger.error("Broadcast resume failed: %s", e)
+        await asyncio.sleep(interval)
+
+# ==================== NOTIFICATIONS ====================
+NOTIFICATION_PENDING = "pending"
+NOTIFICATION_SENDING = "sending"
+NOTIFICATION_SENT = "sent"
+NOTIFICATION_DEAD = "dead"  # Bot bloklangan yoki chat topilmadi
+NOTIFICATION_FAILED = "failed"  # Urinishlar tugadi yoki xabar noto'g'ri
+
+class NotificationOutbox:
+    """Bazadagi navbatdan xabarlarni workerlar orqali yuborish.
+
+    Handlerlar faqat yozuv qo'shadi. Dispetcher pending yozuvlarni shartli
+    UPDATE bilan band qiladi (bir nechta replika xavfsiz) va chat_id bo'yicha
+    workerlarga taqsimlaydi, shuning uchun bitta chatga xabarlar tartibi
+    saqlanadi. Yuborilganlar o'chiriladi, dead/failed yozuvlar tahlil uchun qoladi.
+    """
+
+    def __init__(self, workers: int, batch_size: int, poll_interval: float):
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._inflight = 0
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def __len__(self) -> int:
+        return self._inflight
+
+    @staticmethod
+    def _row(chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> Dict[str, Any]:
+        markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+        return {"chat_id": chat_id, "text": text, "reply_markup": markup, "status": NOTIFICATION_PENDING}
+
+    def add(self, session, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        """Chaqiruvchining tranzaksiyasiga qo'shish - commitdan keyin wake() chaqiring"""
+        session.add(Notification(**self._row(chat_id, text, reply_markup)))
+    
+    def add_many(self, session, items: Sequence[Tuple[int, str, Optional[InlineKeyboardMarkup]]]):
+        for item in items:
+            self.add(session, *item)
+
+    async def enqueue(self, chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+        await self.enqueue_many([(chat_id, text, reply_markup)])
+
+    async def enqueue_many(self, items: Sequence[Tuple[int, str, Optional[InlineKeyboardMarkup]]]):
+        if not items:
+            return
+        async with async_session_maker() as session:
+            await session.execute(insert(Notification), [self._row(*item) for item in items])
+            await session.commit()
+        self.wake()
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _claim(self, limit: int):
+        now = datetime.utcnow()
+        claimable = or_(
+            Notification.status == NOTIFICATION_PENDING,
+            and_(
+                Notification.status == NOTIFICATION_SENDING,
+                Notification.claimed_at < now - timedelta(seconds=settings.notification_lease),
+            ),
+        )
+        async with async_session_maker() as session:
+            ids = (await session.execute(
+                select(Notification.id).where(claimable).order_by(Notification.id).limit(limit)
+            )).scalars().all()
+            if not ids:
+                return []
+            result = await session.execute(
+                update(Notification)
+                .where(Notification.id.in_(ids), claimable)
+                .values(status=NOTIFICATION_SENDING, claimed_at=now)
+                .returning(Notification.id, Notification.chat_id, Notification.text,
+                           Notification.reply_markup, Notification.attempts)
+                .execution_options(synchronize_session=False)
+            )
+            rows = sorted(result.all(), key=lambda row: row.id)
+            # Botni bloklaganlarga yubormaymiz - darhol dead (rate limit sarflanmaydi)
+            unreachable = set((await session.execute(
+                select(User.telegram_id).where(
+                    User.telegram_id.in_({row.chat_id for row in rows}), User.is_reachable == False
+                )
+            )).scalars().all())
+            skipped = [row.id for row in rows if row.chat_id in unreachable]
+            if skipped:
+                await session.execute(
+                    update(Notification)
+                    .where(Notification.id.in_(skipped))
+                    .values(status=NOTIFICATION_DEAD, last_error="unreachable")
+                )
+                metrics.inc("bot_notifications_total", len(skipped), status="skipped")
+                rows = [row for row in rows if row.chat_id not in unreachable]
+            await session.commit()
+        return rows
+
+    async def _deliver(self, bot: Bot, row) -> Tuple[str, int, Optional[str]]:
+        """(holat, urinishlar, xato) qaytaradi"""
+        markup = InlineKeyboardMarkup.model_validate_json(row.reply_markup) if row.reply_markup else None
+        attempts = row.attempts
+        while True:
+            await telegram_limiter.acquire(row.chat_id)
+            try:
+                await bot.send_message(row.chat_id, row.text, reply_markup=markup)
+                return NOTIFICATION_SENT, attempts + 1, None
+            except TelegramRetryAfter as e:
+                # Flood limit urinish hisoblanmaydi - hamma kutadi
+                telegram_limiter.block(e.retry_after)
+                metrics.inc("bot_notifications_total", status="retry_after")
+            except TelegramForbiddenError as e:
+                return NOTIFICATION_DEAD, attempts + 1, e.message
+            except TelegramBadRequest as e:
+                status = NOTIFICATION_DEAD if is_unreachable_error(e) else NOTIFICATION_FAILED
+                return status, attempts + 1, e.message
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                attempts += 1
+                if attempts >= settings.notification_max_attempts:
+                    return NOTIFICATION_FAILED, attempts, str(e)
+                metrics.inc("bot_notifications_total", status="retry")
+                await asyncio.sleep(min(
+                    settings.notification_backoff_max,
+                    settings.notification_backoff_base * 2 ** (attempts - 1),
+                ))
+            except Exception as e:
+                return NOTIFICATION_FAILED, attempts + 1, str(e)
+
+    async def _finish(self, row, status: str, attempts: int, error: Optional[str]):
+        async with async_session_maker() as session:
+            if status == NOTIFICATION_SENT:
+                await session.execute(delete(Notification).where(Notification.id == row.id))
             else:
-                print(f"DEBUG: User {user_id} subscribed to {channel}")
-        except asyncio.TimeoutError:
-            print(f"DEBUG: Timeout checking {channel} for user {user_id}")
+                await session.execute(
+                    update(Notification).where(Notification.id == row.id)
+                    .values(status=status, attempts=attempts, last_error=error)
+                )
+            if status == NOTIFICATION_DEAD:
+                await mark_unreachable(session, [row.chat_id])
+            await session.commit()
+
+    async def _worker(self, bot: Bot, lane: asyncio.Queue):
+        while True:
+            row = await lane.get()
+            try:
+                status, attempts, error = await self._deliver(bot, row)
+                if status != NOTIFICATION_SENT:
+                    logger.warning("Notification %s to %s %s: %s", row.id, row.chat_id, status, error)
+                metrics.inc("bot_notifications_total", status=status)
+                await self._finish(row, status, attempts, error)
+            except Exception as e:
+                logger.error("Notification worker error: %s", e)
+            finally:
+                self._inflight -= 1
+                if self._inflight <= self.batch_size // 2:
+                    self.wake()
+
+    async def run(self, bot: Bot):
+        self._wakeup = asyncio.Event()
+        lanes = [asyncio.Queue() for _ in range(self.workers)]
+        for lane in lanes:
+            spawn_background(self._worker(bot, lane))
+        while True:
+            self._wakeup.clear()
+            free = self.batch_size - self._inflight
+            rows = []
+            if free > 0:
+                try:
+                    rows = await self._claim(free)
+                except Exception as e:
+                    logger.error("Notification claim failed: %s", e)
+            for row in rows:
+                self._inflight += 1
+                # Bitta chat doim bitta workerga tushadi - tartib saqlanadi
+                lanes[row.chat_id % len(lanes)].put_nowait(row)
+            if rows and len(rows) == free:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+notification_outbox = NotificationOutbox(
+    settings.notification_workers,
+    settings.notification_batch_size,
+    settings.notification_poll_interval,
+)
+
+# ==================== WITHDRAWALS ====================
+# Holatlar: pending -> approved | rejected (boshqa o'tishlar yo'q)
+WITHDRAWAL_PENDING = "pending"
+WITHDRAWAL_APPROVED = "approved"
+WITHDRAWAL_REJECTED = "rejected"
+
+async def create_withdrawal(session, telegram_id: int, amount: int, user_info: str,
+                            notifications: Optional[Callable[[Withdrawal], Sequence[Tuple]]] = None):
+    """Ariza yaratish va summani shu tranzaksiyada band qilish.
+
+    Balans yetarli bo'lmasa None qaytaradi (hech narsa yozilmaydi).
+    `notifications(withdrawal)` xabarlari shu tranzaksiyada navbatga qo'shiladi.
+    """
+    withdrawal = Withdrawal(user_id=telegram_id, amount=amount, user_info=user_info, status=WITHDRAWAL_PENDING)
+    session.add(withdrawal)
+    await session.flush()
+    updated = await change_balance(session, telegram_id, -amount, REASON_WITHDRAWAL, ref_id=withdrawal.id)
+    if updated is None:
+        await session.rollback()
+        return None
+    await bump_counter(session, STAT_WITHDRAWALS_PENDING, 1)
+    if notifications:
+        notification_outbox.add_many(session, notifications(withdrawal))
+    await session.commit()
+    if notifications:
+        notification_outbox.wake()
+    return withdrawal
+
+async def resolve_withdrawal(session, withdrawal_id: int, new_status: str,
+                             notifications: Optional[Callable[[Any, Any], Sequence[Tuple]]] = None):
+    """Arizani faqat pending holatidan o'tkazish (shartli UPDATE).
+
+    Ikkinchi bosishda hech narsa o'zgarmaydi va None qaytadi, shuning uchun
+    pul ikki marta qaytarilmaydi. Rad etilganda summa shu tranzaksiyada qaytariladi.
+    `notifications(withdrawal, user)` xabarlari ham shu tranzaksiyada yoziladi.
+    """
+    result = await session.execute(
+        update(Withdrawal)
+        .where(Withdrawal.id == withdrawal_id, Withdrawal.status == WITHDRAWAL_PENDING)
+        .values(status=new_status)
+        .returning(Withdrawal.id, Withdrawal.user_id, Withdrawal.amount, Withdrawal.user_info)
+        .execution_options(synchronize_session=False)
+    )
+    withdrawal = result.one_or_none()
+    if withdrawal is None:
+        return None, None
+    
+    user = None
+    if new_status == WITHDRAWAL_REJECTED:
+        user = await change_balance(
+            session, withdrawal.user_id, withdrawal.amount, REASON_WITHDRAWAL_REFUND, ref_id=withdrawal.id
+        )
+    await bump_counter(session, STAT_WITHDRAWALS_PENDING, -1)
+    if notifications:
+        notification_outbox.add_many(session, notifications(withdrawal, user))
+    await session.commit()
+    if notifications:
+        notification_outbox.wake()
+    return withdrawal, user
+
+def withdrawals_digest(withdrawal_ids: Sequence[int]) -> str:
+    """Admin ko'rgan arizalar ro'yxatining qisqa izi (callback_data 64 baytga sig'adi)"""
+    return hashlib.sha256(",".join(map(str, sorted(withdrawal_ids))).encode()).hexdigest()[:12]
+
+async def resolve_withdrawals_range(session, first_id: int, last_id: int, new_status: str, digest: str,
+                                    notifications: Optional[Callable[[Any], Sequence[Tuple]]] = None):
+    """Admin ko'rgan sahifadagi pending arizalarni bitta UPDATE bilan o'tkazish.
+
+    Oraliqdagi pending arizalar izi `digest` ga mos kelmasa (sahifa
+    ko'rsatilgandan keyin yangi ariza commit bo'lgan yoki boshqasi ko'rib
+    chiqilgan) hech narsa o'zgartirilmaydi va None qaytadi. UPDATE faqat
+    o'qilgan id lar bo'yicha, shuning uchun ko'rilmagan ariza tasdiqlanmaydi.
+    Rad etilganda summalar bitta CASE UPDATE ... RETURNING bilan qaytariladi.
+    Har bir ariza uchun `notifications(withdrawal)` shu tranzaksiyada yoziladi.
+    """
+    withdrawal_ids = (await session.execute(
+        select(Withdrawal.id)
+        .where(Withdrawal.id.between(first_id, last_id), Withdrawal.status == WITHDRAWAL_PENDING)
+    )).scalars().all()
+    if withdrawals_digest(withdrawal_ids) != digest:
+        return None
+    
+    result = await session.execute(
+        update(Withdrawal)
+        .where(Withdrawal.id.in_(withdrawal_ids), Withdrawal.status == WITHDRAWAL_PENDING)
+        .values(status=new_status)
+        .returning(Withdrawal.id, Withdrawal.user_id, Withdrawal.amount, Withdrawal.user_info)
+        .execution_options(synchronize_session=False)
+    )
+    withdrawals = result.all()
+    
+    missing: List[int] = []
+    if withdrawals and new_status == WITHDRAWAL_REJECTED:
+        refunds: Dict[int, int] = {}
+        for withdrawal in withdrawals:
+            refunds[withdrawal.user_id] = refunds.get(withdrawal.user_id, 0) + withdrawal.amount
+        result = await session.execute(
+            update(User)
+            .where(User.telegram_id.in_(refunds))
+            .values(balance=User.balance + case(refunds, value=User.telegram_id))
+            .returning(User.telegram_id)
+            .execution_options(synchronize_session=False)
+        )
+        # Ledger va hisoblagichlar faqat haqiqatan yangilangan foydalanuvchilar uchun
+        refunded = set(result.scalars().all())
+        missing = [w.id for w in withdrawals if w.user_id not in refunded]
+        if missing:
+            logger.warning("Bulk reject: users not found, no refund for withdrawals %s", missing)
+        if refunded:
+            await session.execute(insert(LedgerEntry), [
+                {"user_id": w.user_id, "delta": w.amount, "reason": REASON_WITHDRAWAL_REFUND, "ref_id": w.id}
+                for w in withdrawals if w.user_id in refunded
+            ])
+            total = sum(amount for user_id, amount in refunds.items() if user_id in refunded)
+            counter_name, sign = LEDGER_COUNTERS[REASON_WITHDRAWAL_REFUND]
+            await bump_counter(session, counter_name, sign * total)
+            await bump_counter(session, STAT_BALANCE_TOTAL, total)
+    
+    await bump_counter(session, STAT_WITHDRAWALS_PENDING, -len(withdrawals))
+    if notifications:
+        for withdrawal in withdrawals:
+            if withdrawal.id not in missing:
+                notification_outbox.add_many(session, notifications(withdrawal))
+    await session.commit()
+    if withdrawals and notifications:
+        notification_outbox.wake()
+    return withdrawals
+
+async def build_withdrawals_page(cursor: int = 0) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    """Pending arizalarning bitta sahifasi ((status, id) indeksi bo'yicha keyset)"""
+    page_size = settings.withdrawals_page_size
+    async with async_session_maker() as session:
+        total = (await session.execute(
+            select(func.count(Withdrawal.id)).where(Withdrawal.status == WITHDRAWAL_PENDING)
+        )).scalar() or 0
+        if not total:
+            return None
+        
+        rows = (await session.execute(
+            select(Withdrawal.id, Withdrawal.user_id, Withdrawal.amount, Withdrawal.user_info, Withdrawal.created_at)
+            .where(Withdrawal.status == WITHDRAWAL_PENDING, Withdrawal.id > cursor)
+            .order_by(Withdrawal.id)
+            .limit(page_size + 1)
+        )).all()
+    
+    has_next = len(rows) > page_size
+    rows = rows[:page_size]
+    if not rows:
+        return None
+    
+    lines = [f"📋 Kutilayotgan arizalar: {total} ta\n\n"]
+    for row in rows:
+        lines.append(
+            f"#{row.id} | 🆔 {row.user_id} | 💰 {format_balance(row.amount)} ⭐\n"
+            f"   📅 {row.created_at.strftime('%d.%m.%Y %H:%M')}\n"
+            f"   📝 {row.user_info[:100]}\n\n"
+        )
+    
+    first_id, last_id = rows[0].id, rows[-1].id
+    digest = withdrawals_digest([row.id for row in rows])
+    buttons = [[
+        InlineKeyboardButton(text="✅ Sahifani tasdiqlash", callback_data=f"wbulk_approve_{first_id}_{last_id}_{digest}"),
+        InlineKeyboardButton(text="❌ Sahifani rad etish", callback_data=f"wbulk_reject_{first_id}_{last_id}_{digest}"),
+    ]]
+    navigation = []
+    if cursor:
+        navigation.append(InlineKeyboardButton(text="⏮ Boshiga", callback_data="wpage_0"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"wpage_{last_id}"))
+    if navigation:
+        buttons.append(navigation)
+    return "".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+# ==================== MIDDLEWARE ====================
+class _UserState:
+    __slots__ = ("lock", "tokens", "updated")
+
+    def __init__(self, burst: float):
+        self.lock = asyncio.Lock()
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+class UserGateMiddleware(BaseMiddleware):
+    """Har bir foydalanuvchi updatelarini ketma-ket bajarish va cheklash.
+
+    Holat faqat faol foydalanuvchilar uchun saqlanadi: hajm chegaralangan,
+    bo'sh turgan (lock ushlanmagan) yozuvlar idle_ttl dan keyin o'chiriladi.
+    """
+
+    def __init__(self, rate: float, burst: int, max_size: int, idle_ttl: float):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._states: "OrderedDict[int, _UserState]" = OrderedDict()
+
+    def _evict(self, now: float):
+        # Eng eskisidan boshlab - birinchi saqlanadigan yozuvda to'xtaymiz (nusxa olinmaydi)
+        for _ in range(len(self._states)):
+            user_id, state = next(iter(self._states.items()))
+            idle = now - state.updated > self.idle_ttl
+            if not idle and len(self._states) <= self.max_size:
+                break
+            if state.lock.locked():
+                # Ishlayotgan foydalanuvchini o'chirmaymiz - navbat buziladi, oxiriga suramiz
+                self._states.move_to_end(user_id)
+                continue
+            del self._states[user_id]
+
+    def _get_state(self, user_id: int, now: float) -> _UserState:
+        state = self._states.get(user_id)
+        if state is None:
+            state = _UserState(self.burst)
+            self._states[user_id] = state
+            self._evict(now)
+        else:
+            self._states.move_to_end(user_id)
+        return state
+
+    def _allow(self, state: _UserState, now: float) -> bool:
+        state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+        if state.tokens < 1:
             return False
+        state.tokens -= 1
+        return True
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if user is None or user.id == settings.admin_id:
+            return await handler(event, data)
+        
+        now = time.monotonic()
+        state = self._get_state(user.id, now)
+        if not self._allow(state, now):
+            logger.debug("Throttled update from user %s", user.id)
+            if isinstance(event, CallbackQuery):
+                await event.answer("⏳ Iltimos, sekinroq!")
+            return None
+        
+        async with state.lock:
+            return await handler(event, data)
+
+# ==================== METRICS ====================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def _format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Prometheus matn formatidagi oddiy hisoblagich/gistogramma/gauge to'plami.
+
+    Gauge qiymatlari /metrics so'ralganda callback orqali o'qiladi.
+    """
+
+    def __init__(self):
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._callbacks: Dict[str, Callable[[], Iterable[Tuple[Dict[str, Any], float]]]] = {}
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ("counter", help_text)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str):
+        self._meta[name] = ("histogram", help_text)
+        self._histograms[name] = {}
+
+    def gauge(self, name: str, help_text: str, callback: Callable[[], Iterable[Tuple[Dict[str, Any], float]]]):
+        self._meta[name] = ("gauge", help_text)
+        self._callbacks[name] = callback
+
+    def inc(self, name: str, value: float = 1, **labels):
+        values = self._counters[name]
+        key = tuple(sorted(labels.items()))
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        values = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = Histogram()
+        histogram.observe(value)
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in self._counters[name].items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            elif kind == "histogram":
+                for labels, histogram in self._histograms[name].items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            else:
+                try:
+                    samples = list(self._callbacks[name]())
+                except Exception as e:
+                    logger.error("Metric %s callback failed: %s", name, e)
+                    continue
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+def _cache_samples():
+    total = subscription_cache.hits + subscription_cache.misses
+    yield {}, subscription_cache.hits / total if total else 0.0
+
+def _broadcast_samples(attribute: str):
+    def samples():
+        for job in list(active_broadcasts.values()):
+            yield {"broadcast_id": job.id}, getattr(job, attribute)
+    return samples
+
+metrics = MetricsRegistry()
+metrics.histogram("bot_handler_duration_seconds", "Handler bajarilish vaqti")
+metrics.counter("bot_handler_calls_total", "Handler chaqiruvlari (status bo'yicha)")
+metrics.histogram("bot_api_request_duration_seconds", "Telegram Bot API so'rovlari vaqti")
+metrics.counter("bot_api_requests_total", "Telegram Bot API so'rovlari (metod va natija bo'yicha)")
+metrics.histogram("bot_db_query_duration_seconds", "Bazaga so'rovlar vaqti")
+metrics.counter("bot_db_queries_total", "Bazaga so'rovlar soni")
+metrics.gauge("bot_subscription_cache_hit_ratio", "Obuna keshidan topilgan so'rovlar ulushi", _cache_samples)
+metrics.gauge("bot_subscription_cache_hits", "Obuna keshi topilganlar",
+              lambda: [({}, subscription_cache.hits)])
+metrics.gauge("bot_subscription_cache_misses", "Obuna keshi topilmaganlar",
+              lambda: [({}, subscription_cache.misses)])
+metrics.gauge("bot_subscription_cache_entries", "Obuna keshidagi yozuvlar",
+              lambda: [({}, len(subscription_cache))])
+metrics.counter("bot_notifications_total", "Bildirishnomalar natijasi (sent, retry, dead, failed, skipped)")
+metrics.gauge("bot_notification_queue_size", "Workerlarda ishlanayotgan bildirishnomalar",
+              lambda: [({}, len(notification_outbox))])
+metrics.gauge("bot_broadcast_sent", "Faol broadcast: muvaffaqiyatli yuborilgan", _broadcast_samples("success_count"))
+metrics.gauge("bot_broadcast_failed", "Faol broadcast: xatolik", _broadcast_samples("error_count"))
+metrics.gauge("bot_broadcast_total", "Faol broadcast: jami qabul qiluvchilar", _broadcast_samples("total"))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Ichki middleware: qaysi handler qancha vaqt ishlaganini yozadi"""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        name = data["handler"].callback.__name__
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", time.perf_counter() - start, handler=name)
+            metrics.inc("bot_handler_calls_total", handler=name, status=status)
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """bot.session middleware: Bot API chaqiruvlari metod bo'yicha"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = method.__api_method__
+        status = "ok"
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
         except Exception as e:
-            print(f"DEBUG: Error checking {channel} for user {user_id}: {e}")
-            return False
-    
-    print(f"DEBUG: User {user_id} subscribed to all channels")
-    return True
+            status = type(e).__name__
+            raise
+        finally:
+            metrics.observe("bot_api_request_duration_seconds", time.perf_counter() - start, method=name)
+            metrics.inc("bot_api_requests_total", method=name, status=status)
+
+@listens_for(engine.sync_engine, "before_cursor_execute")
+def _db_query_started(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+@listens_for(engine.sync_engine, "after_cursor_execute")
+def _db_query_finished(conn, cursor, statement, parameters, context, executemany):
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    metrics.inc("bot_db_queries_total", operation=operation)
+    started = getattr(context, "_metrics_started", None)
+    if started is not None:
+        metrics.observe("bot_db_query_duration_seconds", time.perf_counter() - started, operation=operation)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if settings.metrics_token and request.headers.get("Authorization") != f"Bearer {settings.metrics_token}":
+        return web.Response(status=401, text="unauthorized")
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
 
 # ==================== HANDLERS ====================
 dp = Dispatcher()
+user_gate = UserGateMiddleware(
+    settings.throttle_rate,
+    settings.throttle_burst,
+    settings.user_state_max_size,
+    settings.user_state_idle_ttl,
+)
+dp.message.outer_middleware(user_gate)
+dp.callback_query.outer_middleware(user_gate)
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
 
 @dp.callback_query(F.data == "check_subscription")
-async def check_subscription_callback(callback: CallbackQuery):
-    channels = settings.sponsor_channels_list
+async def check_subscription_callback(callback: CallbackQuery, bot_identity: BotIdentity):
+    channels = channel_store.channels
     subscribed_channels = []
     unsubscribed_channels = []
+    unknown_channels = []
+    
+    # Foydalanuvchi o'zi tekshirishni so'radi - eski natijalarni tashlaymiz
+    subscription_cache.invalidate_user(callback.from_user.id, channels)
+    statuses = await get_subscription_statuses(
+        callback.from_user.id, callback.bot, channels, stop_on_first_failure=False
+    )
     
     for channel in channels:
-        try:
-            member = await callback.bot.get_chat_member(channel, callback.from_user.id)
-            if member.status in ['left', 'kicked', 'banned']:
-                unsubscribed_channels.append(channel)
-            else:
-                subscribed_channels.append(channel)
-        except Exception:
+        status = statuses.get(channel)
+        if status:
+            subscribed_channels.append(channel)
+        elif status is None:
+            # Telegram javob bermadi - chiqib ketgan deb hisoblamaymiz
+            unknown_channels.append(channel)
+        else:
             unsubscribed_channels.append(channel)
     
-    # Agar foydalanuvchi kanallardan chiqib ketsa, referral jarimasini qo'llash
-    if unsubscribed_channels and len(subscribed_channels) < len(channels):
-        await process_referral_penalty(callback.from_user.id, callback.bot)
-    
-    channel_buttons = []
-    
-    for channel in unsubscribed_channels:
-        channel_url = f"https://t.me/{channel.lstrip('@')}"
-        channel_buttons.append([InlineKeyboardButton(text=f"❌ {channel}", url=channel_url)])
-    
-    for channel in subscribed_channels:
-        channel_buttons.append([InlineKeyboardButton(text=f"✅ {channel}", url="https://t.me/" + channel.lstrip('@'))])
-    
+    # Faqat aniq left/kicked/banned holatida referral jarimasini qo'llash
     if unsubscribed_channels:
-        channel_buttons.append([InlineKeyboardButton(text="🔄 Obunani qayta tekshirish", callback_data="check_subscription")])
-    else:
-        channel_buttons.append([InlineKeyboardButton(text="🎉 Barcha kanallarga obuna bo'ldingiz!", callback_data="check_subscription")])
+        await process_referral_penalty(callback.from_user.id, callback.bot)
     
     if unsubscribed_channels:
-        text = f"❌ Obuna to'liq emas!\n\n"
-        text += f"📊 Jami kanallar: {len(channels)} ta\n"
-        text += f"✅ Obuna bo'lgan: {len(subscribed_channels)} ta\n"
-        text += f"❌ Obuna bo'lmagan: {len(unsubscribed_channels)} ta\n\n"
-        text += f"🔽 Obuna bo'lmagan kanallar:\n"
-        for channel in unsubscribed_channels:
-            text += f"• {channel}\n"
-        text += f"\n📱 Quyi tugmalarni bosib obuna bo'ling!\n\n"
-        text += f"⚠️ Diqqat: Obuna bo'lmaganingiz uchun:\n"
-        text += f"• Referallaringizdan bonuslar olinmaydi\n"
-        text += f"• Stars yechib olish imkonsiz\n"
-        text += f"• Botning barcha funktsiyalari cheklangan\n\n"
-        text += f"🔄 Obuna bo'lgandan so'ng 'Obunani qayta tekshirish' tugmasini bosing!"
+        text = SUBSCRIPTION_INCOMPLETE_TEMPLATE.format(
+            total=len(channels),
+            subscribed=len(subscribed_channels),
+            unsubscribed=len(unsubscribed_channels),
+            channels="\n".join(
+                [f"• {channel}" for channel in unsubscribed_channels]
+                + [f"• {channel} (⏳ qayta tekshiring)" for channel in unknown_channels]
+            ),
+        )
+    elif unknown_channels:
+        text = SUBSCRIPTION_UNKNOWN_TEMPLATE.format(
+            total=len(channels),
+            subscribed=len(subscribed_channels),
+            unknown=len(unknown_channels),
+            channels="\n".join(f"• {channel}" for channel in unknown_channels),
+        )
     else:
-        text = f"🎉 TABRIKLAYMIZ!\n\n"
-        text += f"✅ Siz barcha {len(channels)} ta kanalga obuna bo'ldingiz!\n"
-        text += f"🚀 Endi botning barcha imkoniyatlaridan foydalanishingiz mumkin:\n\n"
-        text += f"⭐ Balangizni ko'rish\n"
-        text += f"👥 Referallaringizni ko'rish\n"
-        text += f"🔗 Referal havola olish\n"
-        text += f"⭐ Stars yechib olish\n\n"
-        
-        bot_username = (await callback.bot.get_me()).username
-        referral_link = generate_referral_link(callback.from_user.id, bot_username)
-        text += f"🔗 Sizning referal havolangiz:\n{referral_link}"
+        text = SUBSCRIPTION_COMPLETE_TEMPLATE.format(
+            total=len(channels),
+            referral_link=generate_referral_link(callback.from_user.id, bot_identity.username),
+        )
     
-    if not unsubscribed_channels:
+    if not unsubscribed_channels and not unknown_channels:
         await callback.message.delete()
         
         # Obuna bo'lgandan so'ng referral mukofotlarini berish
@@ -274,7 +1991,9 @@ async def check_subscription_callback(callback: CallbackQuery):
             reply_markup=main_menu()
         )
     else:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=channel_buttons)
+        keyboard = subscription_status_keyboard(
+            tuple(unsubscribed_channels), tuple(subscribed_channels), tuple(unknown_channels)
+        )
         await callback.message.edit_text(
             text,
             reply_markup=keyboard
@@ -283,255 +2002,230 @@ async def check_subscription_callback(callback: CallbackQuery):
     await callback.answer("Obuna tekshirildi!")
 
 @dp.message(CommandStart())
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, bot_identity: BotIdentity):
     referrer_id = None
     if message.text.startswith('/start '):
         try:
             referrer_id = int(message.text.split()[1])
         except (ValueError, IndexError):
             pass
+    if referrer_id == message.from_user.id:
+        referrer_id = None
 
-    async with async_session_maker() as session:
-        result = await session.execute(
-            select(User).where(User.telegram_id == message.from_user.id)
+    user, referral_id = await register_user(message.from_user, referrer_id)
+    if referral_id:
+        # Bildirishnomalar commitdan keyin fonda yuboriladi
+        spawn_background(notify_new_referral(referrer_id, message.from_user))
+
+    if message.from_user.id == settings.admin_id:
+        await message.answer(
+            f"👨‍💼 Admin paneliga xush kelibsiz, {message.from_user.first_name}!",
+            reply_markup=admin_menu()
         )
-        user = result.scalar_one_or_none()
+        return
 
-        if not user:
-            user = User(
-                telegram_id=message.from_user.id,
-                username=message.from_user.username,
-                first_name=message.from_user.first_name,
-                referred_by=referrer_id,
-                is_admin=(message.from_user.id == settings.admin_id)
-            )
-            session.add(user)
-            await session.commit()
+    referral_link = generate_referral_link(message.from_user.id, bot_identity.username)
+    
+    if await check_subscription(message.from_user.id, message.bot):
+        await message.answer(
+            f"🎉 Xush kelibsiz, {message.from_user.first_name}!\n\n"
+            f"⭐ Balans: {format_balance(user.balance)} ⭐\n"
+            f"👥 Referallar: {user.referral_count} ta\n\n"
+            f"🔗 Sizning referal havolangiz:\n{referral_link}\n\n"
+            f"Har bir do'stingiz {settings.referral_reward} ⭐ olib keladi!",
+            reply_markup=main_menu()
+        )
+    else:
+        await message.answer(
+            "👋 Assalomu alaykum!\n\n"
+            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
+            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            reply_markup=restricted_menu()
+        )
 
-            # Yangi foydalanuvchi bo'lsa va referal ID bo'lsa
-            if referrer_id and referrer_id != message.from_user.id:
-                # Yangi session ochib referal mukofotini berish
-                async with async_session_maker() as referral_session:
-                    await handle_referral_reward(referral_session, referrer_id, message.from_user.id, message.bot)
+async def register_user(from_user: types.User, referrer_id: Optional[int]):
+    """Foydalanuvchi va referalni bitta tranzaksiyada yozish.
 
-        if message.from_user.id == settings.admin_id:
-            await message.answer(
-                f"👨‍💼 Admin paneliga xush kelibsiz, {message.from_user.first_name}!",
-                reply_markup=admin_menu()
+    INSERT ... ON CONFLICT DO NOTHING parallel /start larda unique xatosiz
+    ishlaydi. Referal faqat yangi foydalanuvchi va mavjud referrer uchun
+    INSERT ... SELECT bilan yoziladi. (user, referral_id) qaytaradi.
+    """
+    now = datetime.utcnow()
+    async with async_session_maker() as session:
+        result = await session.execute(
+            dialect_insert(User)
+            .values(
+                telegram_id=from_user.id,
+                username=from_user.username,
+                first_name=from_user.first_name,
+                balance=0,
+                referral_count=0,
+                referred_by=referrer_id,
+                is_admin=(from_user.id == settings.admin_id),
+                created_at=now,
             )
-            return
-
-        bot_username = (await message.bot.get_me()).username
-        referral_link = generate_referral_link(message.from_user.id, bot_username)
-        
-        if await check_subscription(message.from_user.id, message.bot):
-            await message.answer(
-                f"🎉 Xush kelibsiz, {message.from_user.first_name}!\n\n"
-                f"⭐ Balans: {format_balance(user.balance)} ⭐\n"
-                f"👥 Referallar: {user.referral_count} ta\n\n"
-                f"🔗 Sizning referal havolangiz:\n{referral_link}\n\n"
-                f"Har bir do'stingiz {settings.referral_reward} ⭐ olib keladi!",
-                reply_markup=main_menu()
+            .on_conflict_do_nothing(index_elements=[User.telegram_id])
+            .returning(User.balance, User.referral_count)
+        )
+        user = result.one_or_none()
+        if user is None:
+            # Mavjud foydalanuvchi
+            result = await session.execute(
+                select(User.balance, User.referral_count, User.is_reachable).where(User.telegram_id == from_user.id)
             )
-        else:
-            await message.answer(
-                "👋 Assalomu alaykum!\n\n"
-                "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-                "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
-                reply_markup=restricted_menu()
+            user = result.one()
+            if not user.is_reachable:
+                # /start yuborgan bo'lsa botni blokdan chiqargan
+                await mark_reachable(session, [from_user.id])
+                await session.commit()
+            return user, None
+        
+        await record_signup(session, now)
+        referral_id = None
+        if referrer_id:
+            # Referal egasi bazada bo'lsagina yoziladi (mukofot hali berilmagan)
+            result = await session.execute(
+                insert(Referral)
+                .from_select(
+                    ["referrer_id", "referred_id", "reward_given", "created_at"],
+                    select(
+                        User.telegram_id,
+                        literal(from_user.id, BigInteger),
+                        literal(False),
+                        literal(now, DateTime),
+                    ).where(User.telegram_id == referrer_id),
+                )
+                .returning(Referral.id)
             )
+            referral_id = result.scalar_one_or_none()
+        await session.commit()
+    return user, referral_id
 
-async def handle_referral_reward(session, referrer_id: int, referred_id: int, bot: Bot):
-    result = await session.execute(
-        select(Referral).where(
-            Referral.referrer_id == referrer_id,
-            Referral.referred_id == referred_id
+async def notify_new_referral(referrer_id: int, referred: types.User):
+    """Referal egasi va yangi foydalanuvchiga xabar (commitdan keyin)"""
+    async with async_session_maker() as session:
+        result = await session.execute(
+            select(User.username, User.referral_count).where(User.telegram_id == referrer_id)
         )
-    )
-    existing_referral = result.scalar_one_or_none()
-
-    if existing_referral:
-        return
-
-    # Yangi foydalanuvchi ma'lumotlarini olish
-    result = await session.execute(select(User).where(User.telegram_id == referred_id))
-    referred_user = result.scalar_one_or_none()
-    
-    # Referal egasi ma'lumotlarini olish
-    result = await session.execute(select(User).where(User.telegram_id == referrer_id))
-    referrer = result.scalar_one_or_none()
-    
-    if not referrer or not referred_user:
+        referrer = result.one_or_none()
+    if referrer is None:
         return
-
-    # Referal yozuvini yaratish (mukofot hali berilmagan)
-    referral = Referral(
-        referrer_id=referrer_id,
-        referred_id=referred_id,
-        reward_given=False  # Dastlab mukofot berilmaydi
-    )
-    session.add(referral)
-    await session.commit()
     
-    # Referal egasiga bildirish xabari (mukofotsiz)
-    try:
-        await bot.send_message(
-            referrer_id,
-            f"🎉 YANGI REFERAL KELDI!\n\n"
-            f"👤 Ismi: {referred_user.first_name}\n"
-            f"🆔 ID: {referred_user.telegram_id}\n"
-            (f"@{referred_user.username}\n" if referred_user.username else "") + "\n\n"
-            f"⚠️ Mukofot obuna tasdiqlangandan keyin beriladi!\n"
-            f"📊 Jami referallar: {referrer.referral_count} ta\n\n"
-            f"� Ushbu foydalanuvchi homiy kanallariga obuna bo'lsa,\n"
-            f"sizga {settings.referral_reward} ⭐ beriladi!"
-        )
-    except Exception as e:
-        print(f"Error sending referral notification: {e}")
-
-    # Yangi foydalanuvchiga ham xabar berish
-    try:
-        await bot.send_message(
-            referred_id,
-            f"🎉 Siz muvaffaqiyatli referal bo'ldingiz!\n\n"
-            f"👤 Sizni @{referrer.username if referrer.username else 'admin'} taklif qildi\n"
-            f"🎁 U {settings.referral_reward} ⭐ olishi uchun siz obuna bo'lishingiz kerak!\n\n"
-            f"📺 Homiy kanallariga obuna bo'ling va mukofot oling!\n"
-            f"🚀 Endi siz ham do'stlaringizni taklif qiling!"
-        )
-    except TelegramAPIError:
-        pass
+    username_line = f"👤 Username: @{referred.username}\n" if referred.username else ""
+    await notification_outbox.enqueue_many([(
+        referrer_id,
+        f"🎉 YANGI REFERAL KELDI!\n\n"
+        f"👤 Ismi: {referred.first_name}\n"
+        f"🆔 ID: {referred.id}\n"
+        f"{username_line}\n"
+        f"⚠️ Mukofot obuna tasdiqlangandan keyin beriladi!\n"
+        f"📊 Jami referallar: {referrer.referral_count} ta\n\n"
+        f"💡 Ushbu foydalanuvchi homiy kanallariga obuna bo'lsa,\n"
+        f"sizga {settings.referral_reward} ⭐ beriladi!",
+        None,
+    ), (
+        referred.id,
+        f"🎉 Siz muvaffaqiyatli referal bo'ldingiz!\n\n"
+        f"👤 Sizni @{referrer.username if referrer.username else 'admin'} taklif qildi\n"
+        f"🎁 U {settings.referral_reward} ⭐ olishi uchun siz obuna bo'lishingiz kerak!\n\n"
+        f"📺 Homiy kanallariga obuna bo'ling va mukofot oling!\n"
+        f"🚀 Endi siz ham do'stlaringizni taklif qiling!",
+        None,
+    )])
 
 async def process_pending_referral_rewards(user_id: int, bot: Bot):
-    """Foydalanuvchi obuna bo'lganda, kutayotgan referral mukofotlarini berish"""
+    """Foydalanuvchi obuna bo'lganda, kutayotgan referral mukofotlarini berish.
+
+    Hammasi bitta tranzaksiyada: referallar shartli UPDATE bilan belgilanadi
+    (ix_referrals_referred_reward), referrerlar balansi bitta UPDATE bilan
+    oshiriladi, xabarlar ham shu tranzaksiyada outboxga yoziladi.
+    """
     async with async_session_maker() as session:
-        # Foydalanuvchining referral larini topish
         result = await session.execute(
-            select(Referral).where(
-                Referral.referred_id == user_id,
-                Referral.reward_given == False
-            )
+            update(Referral)
+            .where(Referral.referred_id == user_id, Referral.reward_given == False)
+            .values(reward_given=True)
+            .returning(Referral.id, Referral.referrer_id)
+            .execution_options(synchronize_session=False)
         )
-        pending_referrals = result.scalars().all()
-        
-        if not pending_referrals:
+        claimed = result.all()
+        if not claimed:
             return
+        rewarded = await settle_referrals(session, claimed, settings.referral_reward, REASON_REFERRAL_REWARD)
         
-        for referral in pending_referrals:
-            # Referal egasini topish
-            referrer_result = await session.execute(
-                select(User).where(User.telegram_id == referral.referrer_id)
+        for referral, referrer in rewarded:
+            # Referal egasiga xabar
+            notification_outbox.add(
+                session,
+                referrer.telegram_id,
+                f"🎉 MUKOFOT BERILDI!\n\n"
+                f"👤 {user_id} ID li foydalanuvchi homiy kanallariga obuna bo'ldi!\n"
+                f"⭐ Sizga {settings.referral_reward} ⭐ berildi!\n"
+                f"📊 Yangi balans: {referrer.balance} ⭐\n"
+                f"👥 Jami referallar: {referrer.referral_count} ta"
             )
-            referrer = referrer_result.scalar_one_or_none()
-            
-            if referrer:
-                # Mukofot berish
-                referrer.balance += settings.referral_reward
-                referrer.referral_count += 1
-                
-                # Referral ni yangilash
-                referral.reward_given = True
-                
-                await session.commit()
-                
-                # Referal egasiga xabar yuborish
-                try:
-                    await bot.send_message(
-                        referrer.telegram_id,
-                        f"🎉 MUKOFOT BERILDI!\n\n"
-                        f"👤 {user_id} ID li foydalanuvchi homiy kanallariga obuna bo'ldi!\n"
-                        f"⭐ Sizga {settings.referral_reward} ⭐ berildi!\n"
-                        f"📊 Yangi balans: {referrer.balance} ⭐\n"
-                        f"👥 Jami referallar: {referrer.referral_count} ta"
-                    )
-                except Exception as e:
-                    print(f"Error sending reward notification: {e}")
-                
-                # Foydalanuvchiga ham xabar yuborish
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"🎉 TABRIKLAYMIZ!\n\n"
-                        f"✅ Siz homiy kanallariga muvaffaqiyatli obuna bo'ldingiz!\n"
-                        f"🎁 Sizni chaqirgan @{referrer.username if referrer.username else 'admin'}\n"
-                        f"⭐ U {settings.referral_reward} ⭐ oldi!\n\n"
-                        f"🚀 Endi siz ham do'stlaringizni taklif qiling!"
-                    )
-                except Exception as e:
-                    print(f"Error sending user notification: {e}")
+            # Foydalanuvchiga ham xabar
+            notification_outbox.add(
+                session,
+                user_id,
+                f"🎉 TABRIKLAYMIZ!\n\n"
+                f"✅ Siz homiy kanallariga muvaffaqiyatli obuna bo'ldingiz!\n"
+                f"🎁 Sizni chaqirgan @{referrer.username if referrer.username else 'admin'}\n"
+                f"⭐ U {settings.referral_reward} ⭐ oldi!\n\n"
+                f"🚀 Endi siz ham do'stlaringizni taklif qiling!"
+            )
+        await session.commit()
+    notification_outbox.wake()
 
 async def process_referral_penalty(user_id: int, bot: Bot):
-    """Foydalanuvchi kanallardan chiqib ketsa, referral jarimasini qo'llash"""
+    """Foydalanuvchi kanallardan chiqib ketsa, referral jarimasini qo'llash.
+
+    Referal apply_referral_penalties orqali shartli UPDATE bilan band
+    qilinadi, shuning uchun fon sweeper bilan parallel bo'lsa ham jarima
+    faqat bir marta olinadi.
+    """
     async with async_session_maker() as session:
         # Foydalanuvchining kim tomondan referral ekanligini topish
-        result = await session.execute(select(User).where(User.telegram_id == user_id))
-        user = result.scalar_one_or_none()
-        
-        if not user or not user.referred_by:
-            return
-        
-        # Referral egasini topish
-        referrer_result = await session.execute(
-            select(User).where(User.telegram_id == user.referred_by)
-        )
-        referrer = referrer_result.scalar_one_or_none()
-        
-        if not referrer:
-            return
-        
-        # Referral jarimasini tekshirish (faqat bir marta)
-        penalty_result = await session.execute(
-            select(Referral).where(
-                Referral.referrer_id == user.referred_by,
+        result = await session.execute(
+            select(Referral.id, User.first_name)
+            .join(User, User.telegram_id == Referral.referred_id)
+            .where(
                 Referral.referred_id == user_id,
-                Referral.reward_given == True
+                Referral.referrer_id == User.referred_by,
+                Referral.reward_given == True,
             )
         )
-        existing_referral = penalty_result.scalar_one_or_none()
-        
-        if existing_referral and referrer.balance >= settings.referral_reward:
-            # Jarimani qo'llash
-            referrer.balance -= settings.referral_reward
-            referrer.referral_count = max(0, referrer.referral_count - 1)
-            
-            # Referral ni yangilash
-            existing_referral.reward_given = False  # Jarima belgisi
-            
-            await session.commit()
-            
-            # Referral egasiga xabar
-            try:
-                await bot.send_message(
-                    referrer.telegram_id,
-                    f"⚠️ REFERAL JARIMASI!\n\n"
-                    f"👤 {user.first_name} ({user.telegram_id})\n"
-                    f"📺 Homiy kanallaridan chiqib ketdi!\n"
-                    f"💸 {settings.referral_reward} ⭐ jarimlandi!\n"
-                    f"📊 Yangi balans: {referrer.balance} ⭐\n"
-                    f"👥 Jami referallar: {referrer.referral_count} ta\n\n"
-                    f"🔄 U qayta obuna bo'lsa, mukofot qaytariladi!"
-                )
-                print(f"DEBUG: Penalty notification sent to referrer: {referrer.telegram_id}")
-            except Exception as e:
-                print(f"Error sending penalty notification: {e}")
-            
-            # Foydalanuvchiga xabar
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"⚠️ DIQQAT!\n\n"
-                    f"📺 Siz homiy kanallaridan chiqib ketdingiz!\n"
-                    f"👤 Sizni chaqirgan: @{referrer.username if referrer.username else 'admin'}\n"
-                    f"💸 Uning hisobidan {settings.referral_reward} ⭐ jarimlandi!\n"
-                    f"📊 Yangi balans: {referrer.balance} ⭐\n"
-                    f"� Jami referallar: {referrer.referral_count} ta\n\n"
-                    f"� Qayta obuna bo'lsangiz, mukofot qaytariladi!\n"
-                    f"📱 Obuna bo'lish uchun pastdagi tugmalardan foydalaning!"
-                )
-                print(f"DEBUG: Penalty notification sent to user: {user.telegram_id}")
-            except Exception as e:
-                print(f"Error sending user penalty notification: {e}")
+        row = result.one_or_none()
+    
+    if row is None:
         return
+    
+    def notifications(referral, referrer):
+        return [(
+            referrer.telegram_id,
+            f"⚠️ REFERAL JARIMASI!\n\n"
+            f"👤 {row.first_name} ({user_id})\n"
+            f"📺 Homiy kanallaridan chiqib ketdi!\n"
+            f"💸 {settings.referral_reward} ⭐ jarimlandi!\n"
+            f"📊 Yangi balans: {referrer.balance} ⭐\n"
+            f"👥 Jami referallar: {referrer.referral_count} ta\n\n"
+            f"🔄 U qayta obuna bo'lsa, mukofot qaytariladi!",
+            None,
+        ), (
+            user_id,
+            f"⚠️ DIQQAT!\n\n"
+            f"📺 Siz homiy kanallaridan chiqib ketdingiz!\n"
+            f"👤 Sizni chaqirgan: @{referrer.username if referrer.username else 'admin'}\n"
+            f"💸 Uning hisobidan {settings.referral_reward} ⭐ jarimlandi!\n"
+            f"📊 Yangi balans: {referrer.balance} ⭐\n"
+            f"👥 Jami referallar: {referrer.referral_count} ta\n\n"
+            f"🔄 Qayta obuna bo'lsangiz, mukofot qaytariladi!\n"
+            f"📱 Obuna bo'lish uchun pastdagi tugmalardan foydalaning!",
+            None,
+        )]
+    
+    await apply_referral_penalties([row.id], notifications)
+    return
         
     async with async_session_maker() as session:
         result = await session.execute(select(User).where(User.telegram_id == message.from_user.id))
@@ -547,58 +2241,114 @@ async def process_referral_penalty(user_id: int, bot: Bot):
 async def cmd_referrals(message: Message):
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
     
-    async with async_session_maker() as session:
-        result = await session.execute(
-            select(Referral).where(Referral.referrer_id == message.from_user.id)
-        )
-        referrals = result.scalars().all()
-        
-        if not referrals:
-            await message.answer(
-                "👥 Sizda hali referallar yo'q\n\n"
-                "🔗 Do'stlaringizni referal havolangiz orqali taklif qiling:\n"
-                f"🎁 Har bir referal uchun {format_balance(settings.referral_reward)} ⭐ bonus beriladi!"
-            )
-            return
-        
-        text = f"👥 Sizning referallaringiz:\n\n"
-        text += f"📊 Jami referallar: {len(referrals)} ta\n\n"
-        
-        for i, referral in enumerate(referrals, 1):
-            user_result = await session.execute(
-                select(User).where(User.telegram_id == referral.referred_id)
-            )
-            referred_user = user_result.scalar_one_or_none()
-            
-            if referred_user:
-                status = "✅ Mukofot berilgan" if referral.reward_given else "⏳ Mukofot kutilmoqda"
-                text += f"{i}. {referred_user.first_name}"
-                if referred_user.username:
-                    text += f" (@{referred_user.username})"
-                text += f"\n   ID: {referred_user.telegram_id}"
-                text += f"\n   Sana: {referral.created_at.strftime('%d.%m.%Y')}"
-                text += f"\n   {status}\n\n"
-        
-        await message.answer(text)
+    page = await build_referrals_page(message.from_user.id)
+    if page is None:
+        await message.answer(
+            "👥 Sizda hali referallar yo'q\n\n"
+            "🔗 Do'stlaringizni referal havolangiz orqali taklif qiling:\n"
+            f"🎁 Har bir referal uchun {format_balance(settings.referral_reward)} ⭐ bonus beriladi!"
+        )
+        return
+    
+    text, keyboard = page
+    await message.answer(text, reply_markup=keyboard)
+
+async def build_referrals_page(referrer_id: int, cursor: Optional[int] = None, direction: str = "next",
+                               offset: int = 0) -> Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]:
+    """Referallar ro'yxatining bitta sahifasi (keyset sahifalash, bitta JOIN so'rov)"""
+    page_size = settings.referrals_page_size
+    async with async_session_maker() as session:
+        total = (await session.execute(
+            select(func.count(Referral.id)).where(Referral.referrer_id == referrer_id)
+        )).scalar() or 0
+        if not total:
+            return None
+        
+        stmt = (
+            select(
+                Referral.id,
+                Referral.reward_given,
+                Referral.created_at,
+                User.first_name,
+                User.username,
+                User.telegram_id,
+            )
+            .join(User, User.telegram_id == Referral.referred_id)
+            .where(Referral.referrer_id == referrer_id)
+        )
+        if direction == "prev":
+            stmt = stmt.where(Referral.id < cursor).order_by(Referral.id.desc())
+        else:
+            if cursor is not None:
+                stmt = stmt.where(Referral.id > cursor)
+            stmt = stmt.order_by(Referral.id)
+        rows = (await session.execute(stmt.limit(page_size + 1))).all()
+    
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == "prev":
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    
+    lines = [f"👥 Sizning referallaringiz:\n\n📊 Jami referallar: {total} ta\n\n"]
+    for i, row in enumerate(rows, offset + 1):
+        status = "✅ Mukofot berilgan" if row.reward_given else "⏳ Mukofot kutilmoqda"
+        username = f" (@{row.username})" if row.username else ""
+        lines.append(
+            f"{i}. {row.first_name}{username}\n"
+            f"   ID: {row.telegram_id}\n"
+            f"   Sana: {row.created_at.strftime('%d.%m.%Y')}\n"
+            f"   {status}\n\n"
+        )
+    
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Oldingi", callback_data=f"referrals_prev_{rows[0].id}_{max(0, offset - page_size)}"
+        ))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton(
+            text="Keyingi ➡️", callback_data=f"referrals_next_{rows[-1].id}_{offset + len(rows)}"
+        ))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "".join(lines), keyboard
+
+@dp.callback_query(F.data.startswith("referrals_"))
+async def referrals_page_callback(callback: CallbackQuery):
+    parts = callback.data.split("_")
+    if len(parts) != 4 or parts[1] not in ("next", "prev") or not parts[2].isdigit() or not parts[3].isdigit():
+        await callback.answer("❌ Noto'g'ri callback format!")
+        return
+    
+    page = await build_referrals_page(callback.from_user.id, int(parts[2]), parts[1], int(parts[3]))
+    if page is None:
+        await callback.answer("👥 Sizda hali referallar yo'q")
+        return
+    
+    text, keyboard = page
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramAPIError:
+        pass
+    await callback.answer()
 
 @dp.message(F.text == "🔗 Referal havola")
-async def cmd_referral_link(message: Message):
+async def cmd_referral_link(message: Message, bot_identity: BotIdentity):
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
     
-    bot_username = (await message.bot.get_me()).username
-    referral_link = generate_referral_link(message.from_user.id, bot_username)
+    referral_link = generate_referral_link(message.from_user.id, bot_identity.username)
     
     # Foydalanuvchi admin bilan muloqotligini tekshirish
     if message.from_user.id == settings.admin_id:
@@ -619,11 +2369,10 @@ async def cmd_referral_link(message: Message):
     )
 
 @dp.message(F.text == "⭐ Balans")
-async def cmd_balance(message: Message):
+async def cmd_balance(message: Message, bot_identity: BotIdentity):
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -648,7 +2397,7 @@ async def cmd_balance(message: Message):
             f"⭐ Sizning balansingiz: {format_balance(user.balance)} ⭐\n"
             f"🎁 Referallar soni: {user.referral_count} ta\n"
             f"💰 Minimal yechib olish: {format_balance(settings.minimum_withdrawal)} ⭐\n"
-            f"🔗 Sizning referal havolangiz: {generate_referral_link(message.from_user.id, (await message.bot.get_me()).username)}\n\n"
+            f"🔗 Sizning referal havolangiz: {generate_referral_link(message.from_user.id, bot_identity.username)}\n\n"
             f"⭐ Stars yechib olish uchun pastdagi tugmani bosing!"
         )
         
@@ -674,8 +2423,7 @@ async def cmd_balance(message: Message):
 async def cmd_withdraw(message: Message):
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -711,12 +2459,11 @@ async def cmd_withdraw(message: Message):
 
 @dp.message(F.text == "📞 Admin bilan aloqa")
 async def cmd_contact_admin(message: Message):
-    print(f"DEBUG: Admin contact button pressed by user {message.from_user.id}")
+    logger.debug("Admin contact button pressed by user %s", message.from_user.id)
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -730,19 +2477,15 @@ async def cmd_contact_admin(message: Message):
         "⏰ Admin tez orada javob beradi"
     )
     
-    # Adminga xabar yuborish
-    try:
-        await message.bot.send_message(
-            settings.admin_id,
-            f"📞 FOYDALANUVCHI MULOQOT SO'RADI!\n\n"
-            f"👤 Ism: {message.from_user.first_name}\n"
-            f"🆔 ID: {message.from_user.id}\n"
-            f"👤 Username: @{message.from_user.username or 'none'}\n\n"
-            f"📞 Admin bilan bog'lanish tugmasini bosdi!"
-        )
-        print(f"DEBUG: Admin notification sent for user {message.from_user.id}")
-    except Exception as e:
-        print(f"ERROR: Failed to send admin notification: {e}")
+    # Adminga xabar navbat orqali yuboriladi
+    await notification_outbox.enqueue(
+        settings.admin_id,
+        f"📞 FOYDALANUVCHI MULOQOT SO'RADI!\n\n"
+        f"👤 Ism: {message.from_user.first_name}\n"
+        f"🆔 ID: {message.from_user.id}\n"
+        f"👤 Username: @{message.from_user.username or 'none'}\n\n"
+        f"📞 Admin bilan bog'lanish tugmasini bosdi!"
+    )
 
 @dp.message(F.from_user.id != settings.admin_id)
 async def handle_withdraw_request(message: Message):
@@ -754,13 +2497,13 @@ async def handle_withdraw_request(message: Message):
     button_texts = ["⭐ Balans", "👥 Referallar", "🔗 Referal havola", "⭐ Stars yechib olish", "📞 Admin bilan aloqa"]
     
     if text not in button_texts and (any(keyword in text.lower() for keyword in ['miqdor:', 'username:', 'id:']) or '💰' in text or any(char.isdigit() for char in text)):
-        print(f"DEBUG: Ariza formati topildi: {text}")
+        logger.debug("Ariza formati topildi: %s", text)
         async with async_session_maker() as session:
             result = await session.execute(select(User).where(User.telegram_id == message.from_user.id))
             user = result.scalar_one_or_none()
             
             if user:
-                print(f"DEBUG: Foydalanuvchi topildi: {user.first_name}, balance: {user.balance}")
+                logger.debug("Foydalanuvchi topildi: %s, balance: %s", user.first_name, user.balance)
                 # Miqdorni ajratib olish
                 amount = user.balance  # Default - butun balans
                 for line in text.split('\n'):
@@ -770,7 +2513,7 @@ async def handle_withdraw_request(message: Message):
                             numbers = re.findall(r'\d+', line)
                             if numbers:
                                 amount = int(numbers[0])
-                                print(f"DEBUG: Miqdor topildi: {amount}")
+                                logger.debug("Miqdor topildi: %s", amount)
                                 break
                         except:
                             pass
@@ -791,28 +2534,17 @@ async def handle_withdraw_request(message: Message):
                     )
                     return
                 
-                print(f"DEBUG: Arizani yaratishga tayyor: amount={amount}")
-                # Arizani yaratish
-                withdrawal = Withdrawal(
-                    user_id=user.telegram_id,
-                    amount=amount,
-                    user_info=text,  # Bu yerda foydalanuvchi ma'lumotlari saqlanadi
-                    status="pending"
-                )
-                session.add(withdrawal)
-                await session.commit()
-                print(f"DEBUG: Ariza bazaga saqlandi: {withdrawal.id}")
+                logger.debug("Arizani yaratishga tayyor: amount=%s", amount)
                 
-                # Adminga xabar yuborish
-                try:
+                # Adminga xabar ariza bilan bitta tranzaksiyada navbatga yoziladi
+                def notifications(withdrawal):
                     keyboard = InlineKeyboardMarkup(inline_keyboard=[
                         [
                             InlineKeyboardButton(text="✅ Tasdiqlash", callback_data=f"withdraw_action_{withdrawal.id}_approve"),
                             InlineKeyboardButton(text="❌ Rad etish", callback_data=f"withdraw_action_{withdrawal.id}_reject")
                         ]
                     ])
-                    
-                    await message.bot.send_message(
+                    return [(
                         settings.admin_id,
                         f"🆕 YANGI ARIZA!\n\n"
                         f"👤 Foydalanuvchi: {user.first_name}\n"
@@ -820,12 +2552,20 @@ async def handle_withdraw_request(message: Message):
                         f"💰 Miqdor: {format_balance(amount)} ⭐\n"
                         f"📝 Ariza matni: {text}\n"
                         f"📅 Sana: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\n"
-                        f"⚠️ Arizani tekshirib, tasdiqlang yoki rad eting!",
-                        reply_markup=keyboard
+                        f"⚠️ Arizani tekshirib, tasdiqlang yoki rad eting!\n"
+                        f"📋 Barcha arizalar: /withdrawals",
+                        keyboard,
+                    )]
+                
+                # Arizani yaratish va summani band qilish (bitta tranzaksiya)
+                withdrawal = await create_withdrawal(session, user.telegram_id, amount, text, notifications)
+                if withdrawal is None:
+                    await message.answer(
+                        f"❌ Balansingiz yetarli emas!\n\n"
+                        f"💰 Siz kiritgan: {format_balance(amount)} ⭐"
                     )
-                    print(f"✅ Ariza adminga yuborildi: {user.first_name}")
-                except Exception as e:
-                    print(f"❌ Adminga yuborishda xatolik: {e}")
+                    return
+                logger.debug("Ariza bazaga saqlandi: %s", withdrawal.id)
                 
                 # Foydalanuvchiga javob
                 await message.answer(
@@ -834,16 +2574,11 @@ async def handle_withdraw_request(message: Message):
                     f"📝 Arizangiz adminga yuborildi\n\n"
                     f"⏳ Admin tekshirib, tasdiqlaydi (1-24 soat)\n"
                 )
-                
-                # Balansni kamaytirish
-                user.balance -= amount
-                await session.commit()
-                print(f"DEBUG: Balans kamaytirildi: {user.balance}")
             else:
-                print(f"DEBUG: Foydalanuvchi topilmadi: {message.from_user.id}")
+                logger.debug("Foydalanuvchi topilmadi: %s", message.from_user.id)
                 await message.answer("❌ Sizning ma'lumotlaringiz topilmadi!")
     else:
-        print(f"DEBUG: Ariza formati emas: {text}")
+        logger.debug("Ariza formati emas: %s", text)
         await message.answer(
             "❌ Ariza formati noto'g'ri!\n\n"
             "📝 To'g'ri format:\n"
@@ -855,12 +2590,11 @@ async def handle_withdraw_request(message: Message):
 
 @dp.message(F.text == "📞 Admin bilan aloqa")
 async def cmd_contact_admin(message: Message):
-    print(f"DEBUG: Admin contact button pressed by user {message.from_user.id}")
+    logger.debug("Admin contact button pressed by user %s", message.from_user.id)
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -874,154 +2608,209 @@ async def cmd_contact_admin(message: Message):
         "⏰ Admin tez orada javob beradi"
     )
     
-    # Adminga xabar yuborish
-    try:
-        await message.bot.send_message(
-            settings.admin_id,
-            f"📞 FOYDALANUVCHI MULOQOT SO'RADI!\n\n"
-            f"👤 Ism: {message.from_user.first_name}\n"
-            f"🆔 ID: {message.from_user.id}\n"
-            f"👤 Username: @{message.from_user.username or 'none'}\n\n"
-            f"📞 Admin bilan bog'lanish tugmasini bosdi!"
-        )
-        print(f"DEBUG: Admin notification sent for user {message.from_user.id}")
-    except Exception as e:
-        print(f"ERROR: Failed to send admin notification: {e}")
+    # Adminga xabar navbat orqali yuboriladi
+    await notification_outbox.enqueue(
+        settings.admin_id,
+        f"📞 FOYDALANUVCHI MULOQOT SO'RADI!\n\n"
+        f"👤 Ism: {message.from_user.first_name}\n"
+        f"🆔 ID: {message.from_user.id}\n"
+        f"👤 Username: @{message.from_user.username or 'none'}\n\n"
+        f"📞 Admin bilan bog'lanish tugmasini bosdi!"
+    )
 
 # Admin handlers
 @dp.callback_query(F.data.startswith("withdraw_action_"))
 async def admin_withdraw_action(callback: CallbackQuery):
     """Admin arizani tasdiqlaydi yoki rad etdi"""
-    print(f"DEBUG: Callback received: {callback.data}")
-    print(f"DEBUG: Admin ID: {callback.from_user.id}, Required: {settings.admin_id}")
+    logger.debug("Callback received: %s", callback.data)
+    logger.debug("Admin ID: %s, Required: %s", callback.from_user.id, settings.admin_id)
     
     if callback.from_user.id != settings.admin_id:
-        print(f"DEBUG: Admin check failed - not admin")
+        logger.debug("Admin check failed - not admin")
         await callback.answer("❌ Siz admin emassiz!")
         return
     
-    print(f"DEBUG: Admin check passed")
+    logger.debug("Admin check passed")
     
-    # Callback formatini tekshirish: withdraw_action_1_approve
-    if not callback.data.startswith("withdraw_action_"):
-        log_error(f"Invalid callback prefix: {callback.data}")
+    # Callback formati: withdraw_action_1_approve
+    withdrawal_id_str, _, action = callback.data[len("withdraw_action_"):].partition("_")
+    if not withdrawal_id_str.isdigit() or action not in ("approve", "reject"):
+        logger.error("Invalid callback format: %s", callback.data)
         await callback.answer("❌ Noto'g'ri callback format!")
         return
     
-    # Ma'lumotlarni ajratish
-    parts = callback.data.split("_")
-    if len(parts) != 3:
-        log_error(f"Invalid callback format: {callback.data}, parts: {parts}")
-        await callback.answer("❌ Noto'g'ri callback format!")
+    withdrawal_id = int(withdrawal_id_str)
+    new_status = WITHDRAWAL_APPROVED if action == "approve" else WITHDRAWAL_REJECTED
+    logger.info("Action=%s, Withdrawal ID=%s", action, withdrawal_id)
+    
+    def notifications(withdrawal, updated):
+        if new_status == WITHDRAWAL_APPROVED:
+            return [(
+                withdrawal.user_id,
+                f"🎉 ARIZANGIZ TASDIQLANDI!\n\n"
+                f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
+                f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
+                f"✅ Admin tomonidan tasdiqlandi!\n"
+                f"🚀 Pul yuborilmoqda...\n\n"
+                f"📞 Savollar: @{settings.admin_username}",
+                None,
+            )]
+        new_balance = format_balance(updated.balance) if updated else "?"
+        return [(
+            withdrawal.user_id,
+            f"❌ ARIZANGIZ RAD ETILDI!\n\n"
+            f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
+            f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
+            f"❌ Admin tomonidan rad etildi\n"
+            f"💸 Pul balansingizga qaytarildi\n"
+            f"📊 Yangi balans: {new_balance} ⭐\n\n"
+            f"📞 Savollar: @{settings.admin_username}",
+            None,
+        )]
+    
+    # Foydalanuvchiga xabar ariza holati bilan bitta tranzaksiyada navbatga yoziladi
+    async with async_session_maker() as session:
+        withdrawal, updated = await resolve_withdrawal(session, withdrawal_id, new_status, notifications)
+        
+        if withdrawal is None:
+            current = await session.get(Withdrawal, withdrawal_id)
+            if current is None:
+                logger.debug("Withdrawal not found: %s", withdrawal_id)
+                await callback.answer("❌ Ariza topilmadi!")
+            else:
+                logger.debug("Withdrawal %s already %s", withdrawal_id, current.status)
+                await callback.answer(f"⚠️ Ariza allaqachon ko'rib chiqilgan: {current.status}")
+            return
+        
+        result = await session.execute(select(User.first_name).where(User.telegram_id == withdrawal.user_id))
+        first_name = result.scalar_one_or_none() or withdrawal.user_id
+    
+    if new_status == WITHDRAWAL_APPROVED:
+        admin_text = (
+            f"✅ ARIZA TASDIQLANDI!\n\n"
+            f"👤 Foydalanuvchi: {first_name}\n"
+            f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
+            f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
+            f"🎉 Pul yuborildi!"
+        )
+    else:
+        admin_text = (
+            f"❌ ARIZA RAD ETILDI!\n\n"
+            f"👤 Foydalanuvchi: {first_name}\n"
+            f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
+            f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
+            f"💸 Pul balansga qaytarildi"
+        )
+    
+    await callback.message.edit_text(admin_text)
+    await callback.answer("✅ Ariza boshqarildi!")
+    logger.debug("Action completed: %s", action)
+
+@dp.message(Command("withdrawals"))
+async def admin_withdrawals_list(message: Message):
+    if message.from_user.id != settings.admin_id:
+        await message.answer("❌ Siz admin emassiz!")
         return
     
-    action = parts[2]  # approve yoki reject
-    withdrawal_id_str = parts[1]
+    page = await build_withdrawals_page()
+    if page is None:
+        await message.answer("📋 Kutilayotgan arizalar yo'q")
+        return
     
-    # ID ni tekshirish - faqat raqam va minimal 2 xonali
-    if not withdrawal_id_str.isdigit():
-        log_error(f"Invalid withdrawal ID: {withdrawal_id_str}")
-        await callback.answer("❌ Noto'g'ri callback format! ID kamida 2 ta raqamdan iborat bo'lishi kerak.")
+    text, keyboard = page
+    await message.answer(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("wpage_"))
+async def admin_withdrawals_page(callback: CallbackQuery):
+    if callback.from_user.id != settings.admin_id:
+        await callback.answer("❌ Siz admin emassiz!")
         return
     
-    withdrawal_id = int(withdrawal_id_str)
-    log_info(f"Action={action}, Withdrawal ID={withdrawal_id}")
+    cursor = callback.data[len("wpage_"):]
+    if not cursor.isdigit():
+        await callback.answer("❌ Noto'g'ri callback format!")
+        return
     
-    # Callback answer qilish
-    await callback.answer("✅ Ariza boshqarildi!")
-    log_info(f"Action completed: {action}")
+    page = await build_withdrawals_page(int(cursor))
+    try:
+        if page is None:
+            await callback.message.edit_text("📋 Kutilayotgan arizalar yo'q")
+        else:
+            text, keyboard = page
+            await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramAPIError:
+        pass
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("wbulk_"))
+async def admin_withdrawals_bulk(callback: CallbackQuery):
+    """Sahifadagi barcha arizalarni bitta tranzaksiyada tasdiqlash yoki rad etish"""
+    if callback.from_user.id != settings.admin_id:
+        await callback.answer("❌ Siz admin emassiz!")
+        return
     
-    async with async_session_maker() as session:
-        result = await session.execute(
-            select(Withdrawal).where(Withdrawal.id == withdrawal_id)
-        )
-        withdrawal = result.scalar_one_or_none()
-        
-        if not withdrawal:
-            print(f"DEBUG: Withdrawal not found: {withdrawal_id}")
-            await callback.answer("❌ Ariza topilmadi!")
-            return
-        
-        print(f"DEBUG: Withdrawal found: {withdrawal.id}, status={withdrawal.status}")
-        
-        # Foydalanuvchini topish
-        user_result = await session.execute(
-            select(User).where(User.telegram_id == withdrawal.user_id)
-        )
-        user = user_result.scalar_one_or_none()
-        
-        if not user:
-            print(f"DEBUG: User not found: {withdrawal.user_id}")
-            await callback.answer("❌ Foydalanuvchi topilmadi!")
-            return
-        
-        print(f"DEBUG: User found: {user.first_name}")
-        
-        if action == "approve":
-            withdrawal.status = "approved"
-            await session.commit()
-            print(f"DEBUG: Withdrawal approved, status updated to {withdrawal.status}")
-            
-            # Foydalanuvchiga xabar
-            try:
-                await callback.bot.send_message(
-                    withdrawal.user_id,
-                    f"🎉 ARIZANGIZ TASDIQLANDI!\n\n"
-                    f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
-                    f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
-                    f"✅ Admin tomonidan tasdiqlandi!\n"
-                    f"🚀 Pul yuborilmoqda...\n\n"
-                    f"📞 Savollar: @{settings.admin_username}"
-                )
-                print(f"DEBUG: User notification sent")
-            except Exception as e:
-                print(f"Error sending user notification: {e}")
-            
-            await callback.message.edit_text(
-                f"✅ ARIZA TASDIQLANDI!\n\n"
-                f"👤 Foydalanuvchi: {user.first_name}\n"
-                f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
-                f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
-                f"🎉 Pul yuborildi!"
+    # Callback formati: wbulk_approve_<birinchi id>_<oxirgi id>_<ro'yxat izi>
+    parts = callback.data.split("_")
+    if (len(parts) != 5 or parts[1] not in ("approve", "reject")
+            or not parts[2].isdigit() or not parts[3].isdigit()):
+        await callback.answer("❌ Noto'g'ri callback format!")
+        return
+    
+    action, first_id, last_id, digest = parts[1], int(parts[2]), int(parts[3]), parts[4]
+    new_status = WITHDRAWAL_APPROVED if action == "approve" else WITHDRAWAL_REJECTED
+    
+    def notifications(withdrawal):
+        if new_status == WITHDRAWAL_APPROVED:
+            text = (
+                f"🎉 ARIZANGIZ TASDIQLANDI!\n\n"
+                f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n\n"
+                f"✅ Admin tomonidan tasdiqlandi!\n"
+                f"🚀 Pul yuborilmoqda...\n\n"
+                f"📞 Savollar: @{settings.admin_username}"
             )
-            print(f"DEBUG: Admin message updated")
-            
-        elif action == "reject":
-            withdrawal.status = "rejected"
-            print(f"DEBUG: Withdrawal rejected, status updated to {withdrawal.status}")
-            
-            # Pulni qaytarib berish
-            user.balance += withdrawal.amount
-            await session.commit()
-            print(f"DEBUG: Balance restored: {user.balance}")
-            
-            # Foydalanuvchiga xabar
-            try:
-                await callback.bot.send_message(
-                    withdrawal.user_id,
-                    f"❌ ARIZANGIZ RAD ETILDI!\n\n"
-                    f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
-                    f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
-                    f"❌ Admin tomonidan rad etildi\n"
-                    f"💸 Pul balansingizga qaytarildi\n"
-                    f"📊 Yangi balans: {format_balance(user.balance)} ⭐\n\n"
-                    f"📞 Savollar: @{settings.admin_username}"
-                )
-                print(f"DEBUG: User rejection notification sent")
-            except Exception as e:
-                print(f"Error sending user rejection notification: {e}")
-            
-            await callback.message.edit_text(
-                f"❌ ARIZA RAD ETILDI!\n\n"
-                f"👤 Foydalanuvchi: {user.first_name}\n"
-                f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n"
-                f"📝 Ma'lumotlar: {withdrawal.user_info}\n\n"
-                f"💸 Pul balansga qaytarildi"
+        else:
+            text = (
+                f"❌ ARIZANGIZ RAD ETILDI!\n\n"
+                f"💰 Miqdor: {format_balance(withdrawal.amount)} ⭐\n\n"
+                f"❌ Admin tomonidan rad etildi\n"
+                f"💸 Pul balansingizga qaytarildi\n\n"
+                f"📞 Savollar: @{settings.admin_username}"
             )
-            print(f"DEBUG: Admin rejection message updated")
-        
-        await callback.answer("✅ Ariza boshqarildi!")
-        print(f"DEBUG: Action completed: {action}")
+        return [(withdrawal.user_id, text, None)]
+    
+    async with async_session_maker() as session:
+        withdrawals = await resolve_withdrawals_range(session, first_id, last_id, new_status, digest, notifications)
+    
+    if withdrawals is None:
+        # Sahifa eskirgan - hech narsa o'zgarmadi, yangi ro'yxatni ko'rsatamiz
+        page = await build_withdrawals_page(first_id - 1)
+        try:
+            if page is None:
+                await callback.message.edit_text("📋 Kutilayotgan arizalar qolmadi")
+            else:
+                text, keyboard = page
+                await callback.message.edit_text("⚠️ Ro'yxat o'zgardi, qayta tekshiring!\n\n" + text, reply_markup=keyboard)
+        except TelegramAPIError:
+            pass
+        await callback.answer("⚠️ Ro'yxat o'zgardi, hech narsa bajarilmadi")
+        return
+    logger.info("Bulk %s: %s withdrawals (#%s-#%s)", action, len(withdrawals), first_id, last_id)
+    
+    total = sum(withdrawal.amount for withdrawal in withdrawals)
+    label = "✅ Tasdiqlandi" if new_status == WITHDRAWAL_APPROVED else "❌ Rad etildi"
+    summary = f"{label}: {len(withdrawals)} ta ariza, {format_balance(total)} ⭐\n\n"
+    
+    # Keyingi sahifani darhol ko'rsatish
+    page = await build_withdrawals_page(last_id)
+    try:
+        if page is None:
+            await callback.message.edit_text(summary + "📋 Kutilayotgan arizalar qolmadi")
+        else:
+            text, keyboard = page
+            await callback.message.edit_text(summary + text, reply_markup=keyboard)
+    except TelegramAPIError:
+        pass
+    await callback.answer(label)
 
 @dp.message(F.text == "👥 Foydalanuvchilar")
 async def admin_users_list(message: Message):
@@ -1030,21 +2819,18 @@ async def admin_users_list(message: Message):
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
 
     async with async_session_maker() as session:
-        # Umumiy statistika
-        user_count_result = await session.execute(select(func.count(User.id)))
-        total_users = user_count_result.scalar()
-        
-        balance_result = await session.execute(select(func.sum(User.balance)))
-        total_balance = balance_result.scalar() or 0
+        # Umumiy statistika (hisoblagichlardan)
+        stats = await get_counters(session, STAT_USERS_TOTAL, STAT_BALANCE_TOTAL)
+        total_users = stats[STAT_USERS_TOTAL]
+        total_balance = stats[STAT_BALANCE_TOTAL]
         
-        # Oxirgi foydalanuvchilar
+        # Oxirgi foydalanuvchilar (created_at indeksi)
         result = await session.execute(
             select(User).order_by(User.created_at.desc()).limit(10)
         )
@@ -1074,8 +2860,7 @@ async def admin_balance_change(message: Message):
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -1095,22 +2880,29 @@ async def admin_statistics(message: Message):
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
 
     async with async_session_maker() as session:
-        user_count_result = await session.execute(select(func.count(User.id)))
-        user_count = user_count_result.scalar()
-
-        balance_result = await session.execute(select(func.sum(User.balance)))
-        total_balance = balance_result.scalar() or 0
+        signups_today = signups_counter(datetime.utcnow())
+        totals = await get_counters(
+            session, "total_issued", "total_withdrawn", "total_penalties",
+            STAT_USERS_TOTAL, STAT_BALANCE_TOTAL, STAT_WITHDRAWALS_PENDING, STAT_REFERRALS_REWARDED,
+            STAT_USERS_UNREACHABLE, signups_today,
+        )
 
         text = f"📊 **Bot statistikasi:**\n\n"
-        text += f"👥 Jami foydalanuvchilar: {user_count} ta\n"
-        text += f"⭐ Jami balans: {format_balance(total_balance)} ⭐\n\n"
+        text += f"👥 Jami foydalanuvchilar: {totals[STAT_USERS_TOTAL]} ta\n"
+        text += f"🆕 Bugun qo'shilganlar: {totals[signups_today]} ta\n"
+        text += f"🚫 Botni bloklaganlar: {totals[STAT_USERS_UNREACHABLE]} ta\n"
+        text += f"⭐ Jami balans: {format_balance(totals[STAT_BALANCE_TOTAL])} ⭐\n\n"
+        text += f"👥 Mukofotlangan referallar: {totals[STAT_REFERRALS_REWARDED]} ta\n"
+        text += f"📋 Kutilayotgan arizalar: {totals[STAT_WITHDRAWALS_PENDING]} ta\n\n"
+        text += f"🎁 Jami berilgan: {format_balance(totals['total_issued'])} ⭐\n"
+        text += f"💸 Jami yechilgan: {format_balance(totals['total_withdrawn'])} ⭐\n"
+        text += f"⚠️ Jami jarimalar: {format_balance(totals['total_penalties'])} ⭐\n\n"
         text += f"⭐ Minimal yechib olish: {format_balance(settings.minimum_withdrawal)} ⭐\n"
         text += f"🎁 Referal mukofoti: {format_balance(settings.referral_reward)} ⭐"
 
@@ -1123,8 +2915,7 @@ async def admin_settings(message: Message):
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -1134,7 +2925,7 @@ async def admin_settings(message: Message):
     text += f"🆔 Admin ID: {settings.admin_id}\n"
     text += f"⭐ Referal mukofoti: {settings.referral_reward} ⭐\n"
     text += f"⭐ Minimal yechib olish: {settings.minimum_withdrawal} ⭐\n"
-    text += f"📺 Sponsor kanallar: {len(settings.sponsor_channels_list)} ta\n"
+    text += f"📺 Sponsor kanallar: {len(channel_store.channels)} ta\n"
     railway_status = "Ha" if settings.is_railway else "Yo'q"
     text += f"🚀 Railway rejimi: {railway_status}"
     
@@ -1147,8 +2938,7 @@ async def admin_broadcast(message: Message):
     
     if not await check_subscription(message.from_user.id, message.bot):
         await message.answer(
-            "🔒 Botdan to'liq foydalanish uchun homiy kanallarimizga obuna bo'ling!\n\n"
-            "📺 Obuna bo'lgandan so'ng barcha funktsiyalar mavjud bo'ladi.",
+            SUBSCRIBE_REQUIRED_TEXT,
             reply_markup=restricted_menu()
         )
         return
@@ -1165,7 +2955,7 @@ async def admin_sponsor_channels(message: Message):
     if message.from_user.id != settings.admin_id:
         return
 
-    current_channels = settings.sponsor_channels_list
+    current_channels = channel_store.channels
     if current_channels:
         text = f"📺 Joriy homiy kanallar:\n\n"
         for i, channel in enumerate(current_channels, 1):
@@ -1185,7 +2975,7 @@ async def admin_sponsor_channels(message: Message):
 # Command handlers
 @dp.message(Command("addchannel"))
 async def add_sponsor_channel(message: Message):
-    print(f"DEBUG: addchannel command received: '{message.text}'")
+    logger.debug("addchannel command received: '%s'", message.text)
     if message.from_user.id != settings.admin_id:
         await message.answer("❌ Siz admin emassiz!")
         return
@@ -1203,30 +2993,24 @@ async def add_sponsor_channel(message: Message):
     if not channel.startswith('@'):
         channel = '@' + channel
 
-    current_channels = settings.sponsor_channels_list
-    print(f"DEBUG: Current channels before adding: {current_channels}")
-    print(f"DEBUG: Adding channel: {channel}")
+    logger.debug("Adding channel: %s", channel)
     
-    if channel in current_channels:
+    if not await channel_store.add(channel):
         await message.answer(f"❌ Kanal allaqachon qo'shilgan: {channel}")
         return
 
-    current_channels.append(channel)
-    settings.sponsor_channels = ','.join(current_channels)
-    
-    print(f"DEBUG: Updated sponsor_channels: {settings.sponsor_channels}")
-    print(f"DEBUG: Updated sponsor_channels_list: {settings.sponsor_channels_list}")
+    logger.debug("Updated sponsor channels: %s", channel_store.channels)
     
     await message.answer(
         f"✅ Kanal muvaffaqiyatli qo'shildi!\n\n"
         f"📺 {channel}\n"
-        f"📊 Jami kanallar: {len(current_channels)} ta\n"
+        f"📊 Jami kanallar: {len(channel_store.channels)} ta\n"
         f"💾 Bot qayta ishga tushganda ham eslab qolinadi"
     )
 
 @dp.message(Command("removechannel"))
 async def remove_sponsor_channel(message: Message):
-    print(f"DEBUG: removechannel command received: '{message.text}'")
+    logger.debug("removechannel command received: '%s'", message.text)
     if message.from_user.id != settings.admin_id:
         await message.answer("❌ Siz admin emassiz!")
         return
@@ -1244,29 +3028,25 @@ async def remove_sponsor_channel(message: Message):
     if not channel.startswith('@'):
         channel = '@' + channel
 
-    current_channels = settings.sponsor_channels_list
-    if channel not in current_channels:
+    if not await channel_store.remove(channel):
         await message.answer(f"❌ Kanal topilmadi: {channel}")
         return
-
-    current_channels.remove(channel)
-    settings.sponsor_channels = ','.join(current_channels)
     
     await message.answer(
         f"✅ Kanal muvaffaqiyatli o'chirildi!\n\n"
         f"📺 {channel}\n"
-        f"📊 Qolgan kanallar: {len(current_channels)} ta\n"
+        f"📊 Qolgan kanallar: {len(channel_store.channels)} ta\n"
         f"💾 Bot qayta ishga tushganda ham eslab qolinadi"
     )
 
 @dp.message(Command("clearchannels"))
 async def clear_sponsor_channels(message: Message):
-    print(f"DEBUG: clearchannels command received: '{message.text}'")
+    logger.debug("clearchannels command received: '%s'", message.text)
     if message.from_user.id != settings.admin_id:
         await message.answer("❌ Siz admin emassiz!")
         return
 
-    settings.sponsor_channels = ""
+    await channel_store.clear()
     
     await message.answer(
         "✅ Barcha homiy kanallar o'chirildi!\n\n"
@@ -1275,6 +3055,116 @@ async def clear_sponsor_channels(message: Message):
         "/addchannel @kanal_nomi"
     )
 
+def _parse_broadcast_id(message: Message) -> Optional[int]:
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip().lstrip('#').isdigit():
+        return None
+    return int(parts[1].strip().lstrip('#'))
+
+def format_broadcast_status(broadcast: Broadcast) -> str:
+    job = active_broadcasts.get(broadcast.id)
+    success_count = job.success_count if job else broadcast.success_count
+    error_count = job.error_count if job else broadcast.error_count
+    title = "Forward xabar" if broadcast.kind == "forward" else "Xabar"
+    return (
+        f"📢 Broadcast #{broadcast.id} ({title})\n"
+        f"📌 Holat: {BROADCAST_STATUS_LABELS.get(broadcast.status, broadcast.status)}\n"
+        f"📊 Muvaffaqiyatli: {success_count} ta\n"
+        f"❌ Xatolik: {error_count} ta\n"
+        f"👥 Jami: {broadcast.total} ta\n"
+        f"📅 Sana: {broadcast.created_at.strftime('%d.%m.%Y %H:%M')}"
+    )
+
+@dp.message(Command("broadcasts"))
+async def list_broadcasts(message: Message):
+    if message.from_user.id != settings.admin_id:
+        await message.answer("❌ Siz admin emassiz!")
+        return
+
+    async with async_session_maker() as session:
+        result = await session.execute(select(Broadcast).order_by(Broadcast.id.desc()).limit(10))
+        broadcasts = result.scalars().all()
+
+    if not broadcasts:
+        await message.answer("📢 Hali broadcastlar yo'q")
+        return
+
+    text = "📢 Oxirgi broadcastlar:\n\n"
+    text += "\n\n".join(format_broadcast_status(broadcast) for broadcast in broadcasts)
+    text += (
+        "\n\n🔧 Boshqarish:\n"
+        "• Holat: /bstatus ID\n"
+        "• To'xtatish: /bpause ID\n"
+        "• Davom ettirish: /bresume ID\n"
+        "• Bekor qilish: /bcancel ID"
+    )
+    await message.answer(text)
+
+@dp.message(Command("bstatus", "bpause", "bresume", "bcancel"))
+async def manage_broadcast(message: Message):
+    if message.from_user.id != settings.admin_id:
+        await message.answer("❌ Siz admin emassiz!")
+        return
+
+    command = message.text.split(maxsplit=1)[0].lstrip('/').split('@')[0]
+    broadcast_id = _parse_broadcast_id(message)
+    if broadcast_id is None:
+        await message.answer(
+            "❌ Noto'g'ri format!\n\n"
+            "To'g'ri format:\n"
+            f"/{command} ID"
+        )
+        return
+
+    async with async_session_maker() as session:
+        broadcast = await session.get(Broadcast, broadcast_id)
+        if not broadcast:
+            await message.answer(f"❌ Broadcast topilmadi: #{broadcast_id}")
+            return
+
+        job = active_broadcasts.get(broadcast_id)
+
+        if command == "bpause" or command == "bcancel":
+            new_status = "paused" if command == "bpause" else "cancelled"
+            allowed = ("running",) if command == "bpause" else ("running", "paused")
+            # Boshqa replikadagi vazifa holatni keyingi checkpointda o'qib to'xtaydi
+            result = await session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast_id, Broadcast.status.in_(allowed))
+                .values(status=new_status)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            if not result.rowcount:
+                await message.answer(f"❌ Broadcast #{broadcast_id} holati: {BROADCAST_STATUS_LABELS[broadcast.status]}")
+                return
+            if job:
+                job.stop(new_status)
+            await message.answer(f"✅ Broadcast #{broadcast_id}: {BROADCAST_STATUS_LABELS[new_status]}")
+            return
+
+        if command == "bresume":
+            # Boshqa replikada ishlayotgan (lease yangi) broadcast olinmaydi
+            claimed = None if job else await claim_broadcast(session, broadcast_id, include_paused=True)
+            await session.commit()
+            if claimed is None:
+                await message.answer(f"❌ Broadcast #{broadcast_id} holati: {BROADCAST_STATUS_LABELS[broadcast.status]}")
+                return
+            run_broadcast_job(message.bot, claimed)
+            await message.answer(f"▶️ Broadcast #{broadcast_id} davom ettirilmoqda")
+            return
+
+    await message.answer(format_broadcast_status(broadcast))
+
+@dp.message(Command("refreshbot"))
+async def refresh_bot_identity(message: Message, bot_identity: BotIdentity):
+    if message.from_user.id != settings.admin_id:
+        await message.answer("❌ Siz admin emassiz!")
+        return
+
+    me = await bot_identity.refresh(message.bot)
+    await message.answer(f"✅ Bot ma'lumotlari yangilandi: @{me.username}")
+
 # Balance change handler
 @dp.message(F.text.regexp(r'^\d+ [+-]\d+$'))
 async def process_balance_change(message: Message):
@@ -1287,22 +3177,21 @@ async def process_balance_change(message: Message):
         operation = parts[1]
         amount = int(operation[1:])
 
+        delta = amount if operation.startswith('+') else -amount
+
         async with async_session_maker() as session:
-            result = await session.execute(select(User).where(User.telegram_id == user_id))
-            user = result.scalar_one_or_none()
+            user = await change_balance(session, user_id, delta, REASON_ADMIN_ADJUST)
             
             if not user:
-                await message.answer(f"❌ Foydalanuvchi topilmadi: {user_id}")
+                # Sababini aniqlash: foydalanuvchi yo'q yoki balans yetarli emas
+                result = await session.execute(select(User.balance).where(User.telegram_id == user_id))
+                current_balance = result.scalar_one_or_none()
+                if current_balance is None:
+                    await message.answer(f"❌ Foydalanuvchi topilmadi: {user_id}")
+                else:
+                    await message.answer(f"❌ Yetarli balans yo'q! Joriy balans: {format_balance(current_balance)} ⭐")
                 return
             
-            if operation.startswith('+'):
-                user.balance += amount
-            else:
-                if user.balance < amount:
-                    await message.answer(f"❌ Yetarli balans yo'q! Joriy balans: {format_balance(user.balance)} ⭐")
-                    return
-                user.balance -= amount
-            
             await session.commit()
             
             await message.answer(
@@ -1319,39 +3208,22 @@ async def process_balance_change(message: Message):
 @dp.message(F.from_user.id == settings.admin_id, F.forward_from_chat)
 async def handle_admin_forward_broadcast(message: Message):
     try:
-        async with async_session_maker() as session:
-            result = await session.execute(select(User))
-            users = result.scalars().all()
-            
-            success_count = 0
-            error_count = 0
-            
-            for user in users:
-                try:
-                    await message.bot.forward_message(
-                        chat_id=user.telegram_id,
-                        from_chat_id=message.forward_from_chat.id,
-                        message_id=message.forward_from_message_id
-                    )
-                    success_count += 1
-                except Exception:
-                    error_count += 1
-            
-            await message.answer(
-                f"✅ Forward xabar yuborildi!\n\n"
-                f"📊 Muvaffaqiyatli: {success_count} ta\n"
-                f"❌ Xatolik: {error_count} ta\n"
-                f"👥 Jami: {len(users)} ta foydalanuvchi"
-            )
-            
-    except Exception:
+        await start_broadcast(
+            message.bot,
+            message.chat.id,
+            "forward",
+            from_chat_id=message.forward_from_chat.id,
+            message_id=message.forward_from_message_id,
+        )
+    except Exception as e:
+        logger.error("Forward broadcast failed: %s", e)
         await message.answer("❌ Forward xabar yuborishda xatolik yuz berdi!")
 
 @dp.message(F.from_user.id == settings.admin_id, F.text & ~F.command)
 async def handle_admin_text_broadcast(message: Message):
     message_text = message.text.strip()
     
-    print(f"DEBUG: Admin text received: '{message_text}'")
+    logger.debug("Admin text received: '%s'", message_text)
     
     button_texts = [
         "👥 Foydalanuvchilar", "⭐ Balansni o'zgartirish", "📊 Statistika", 
@@ -1359,54 +3231,369 @@ async def handle_admin_text_broadcast(message: Message):
     ]
     
     if message_text in button_texts:
-        print(f"DEBUG: Button text detected, skipping broadcast")
+        logger.debug("Button text detected, skipping broadcast")
         return
     
     if message_text.lower() == 'bekor':
         await message.answer("❌ Xabar yuborish bekor qilindi.")
         return
     
-    print(f"DEBUG: Starting broadcast to all users")
+    logger.debug("Starting broadcast to all users")
     try:
+        await start_broadcast(message.bot, message.chat.id, "text", text=message_text)
+    except Exception as e:
+        logger.error("Text broadcast failed: %s", e)
+        await message.answer("❌ Xabar yuborishda xatolik yuz berdi!")
+
+# ==================== PENALTY SWEEPER ====================
+async def apply_referral_penalties(referral_ids: Sequence[int],
+                                   notifications: Optional[Callable[[Any, Any], Sequence[Tuple]]] = None):
+    """Kanaldan chiqqanlar uchun jarimalarni bitta tranzaksiyada qo'llash.
+
+    Avval referallar shartli UPDATE bilan band qilinadi (qayta jarima yo'q),
+    so'ng referrerlar balansi settle_referrals bilan kamaytiriladi.
+    `notifications(referral, referrer)` xabarlari shu tranzaksiyada navbatga qo'shiladi.
+    """
+    if not referral_ids:
+        return []
+    async with async_session_maker() as session:
+        result = await session.execute(
+            update(Referral)
+            .where(Referral.id.in_(referral_ids), Referral.reward_given == True)
+            .values(reward_given=False)
+            .returning(Referral.id, Referral.referrer_id, Referral.referred_id)
+            .execution_options(synchronize_session=False)
+        )
+        claimed = result.all()
+        if not claimed:
+            return []
+        penalized = await settle_referrals(session, claimed, -settings.referral_reward, REASON_REFERRAL_PENALTY)
+        if notifications:
+            for referral, referrer in penalized:
+                notification_outbox.add_many(session, notifications(referral, referrer))
+        await session.commit()
+    if penalized and notifications:
+        notification_outbox.wake()
+    return penalized
+
+class PenaltySweeper:
+    """Mukofot berilgan referallarni keyset sahifalari bilan aylanib chiqish.
+
+    getChatMember so'rovlari alohida TokenBucket bilan cheklanadi, shuning
+    uchun yuklama oldindan ma'lum. Javob olinmagan foydalanuvchi jarimalanmaydi.
+    """
+
+    def __init__(self, rate: float, batch_size: int):
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.last_referral_id = 0
+        self.checked = 0
+        self.penalized = 0
+
+    async def _has_left(self, bot: Bot, user_id: int, channels: Sequence[str]) -> Optional[bool]:
+        """True - kamida bitta kanaldan chiqqan, None - aniqlab bo'lmadi"""
+        for channel in channels:
+            if subscription_cache.get(user_id, channel):
+                continue
+            await self.bucket.acquire()
+            try:
+                member = await bot.get_chat_member(channel, user_id)
+            except TelegramRetryAfter as e:
+                self.bucket.block(e.retry_after)
+                return None
+            except Exception as e:
+                logger.debug("Sweep check failed for %s in %s: %s", user_id, channel, e)
+                return None
+            is_member = member.status not in NOT_SUBSCRIBED_STATUSES
+            subscription_cache.set(user_id, channel, is_member)
+            if not is_member:
+                return True
+        return False
+
+    async def _next_batch(self):
         async with async_session_maker() as session:
-            result = await session.execute(select(User))
-            users = result.scalars().all()
-            
-            success_count = 0
-            error_count = 0
+            result = await session.execute(
+                select(Referral.id, Referral.referred_id, User.first_name)
+                .join(User, User.telegram_id == Referral.referred_id)
+                .where(Referral.reward_given == True, Referral.id > self.last_referral_id)
+                .order_by(Referral.id)
+                .limit(self.batch_size)
+            )
+            return result.all()
+
+    def _notifications(self, referral, referrer, first_name: str):
+        return [(
+            referrer.telegram_id,
+            f"⚠️ REFERAL JARIMASI!\n\n"
+            f"👤 {first_name} ({referral.referred_id})\n"
+            f"📺 Homiy kanallaridan chiqib ketdi!\n"
+            f"💸 {settings.referral_reward} ⭐ jarimlandi!\n"
+            f"📊 Yangi balans: {referrer.balance} ⭐\n"
+            f"👥 Jami referallar: {referrer.referral_count} ta\n\n"
+            f"🔄 U qayta obuna bo'lsa, mukofot qaytariladi!",
+            None,
+        ), (
+            referral.referred_id,
+            f"⚠️ DIQQAT!\n\n"
+            f"📺 Siz homiy kanallaridan chiqib ketdingiz!\n"
+            f"👤 Sizni chaqirgan: @{referrer.username if referrer.username else 'admin'}\n"
+            f"💸 Uning hisobidan {settings.referral_reward} ⭐ jarimlandi!\n\n"
+            f"🔄 Qayta obuna bo'lsangiz, mukofot qaytariladi!\n"
+            f"📱 Obuna bo'lish uchun /start ni bosing!",
+            None,
+        )]
+
+    async def sweep(self, bot: Bot, renew: Optional[Callable[[], Awaitable[bool]]] = None) -> int:
+        """Bitta to'liq aylanish, qo'llangan jarimalar sonini qaytaradi"""
+        self.last_referral_id = 0
+        penalized_total = 0
+        while True:
+            if renew and not await renew():
+                logger.warning("Penalty sweep lease lost, stopping")
+                break
+            channels = channel_store.channels
+            if not channels:
+                break
+            rows = await self._next_batch()
+            if not rows:
+                break
+            self.last_referral_id = rows[-1].id
             
-            for user in users:
-                try:
-                    await message.bot.send_message(
-                        user.telegram_id,
-                        f"📢 ADMIN XABARI\n\n{message_text}"
-                    )
-                    success_count += 1
-                except Exception:
-                    error_count += 1
+            left = []
+            for row in rows:
+                has_left = await self._has_left(bot, row.referred_id, channels)
+                self.checked += 1
+                if has_left:
+                    left.append(row)
             
-            await message.answer(
-                f"✅ Xabar yuborildi!\n\n"
-                f"📊 Muvaffaqiyatli: {success_count} ta\n"
-                f"❌ Xatolik: {error_count} ta\n"
-                f"👥 Jami: {len(users)} ta foydalanuvchi"
+            names = {row.id: row.first_name for row in left}
+            penalized = await apply_referral_penalties(
+                [row.id for row in left],
+                lambda referral, referrer: self._notifications(referral, referrer, names[referral.id]),
+            )
+            penalized_total += len(penalized)
+            self.penalized += len(penalized)
+        logger.info("Penalty sweep finished: %s penalties", penalized_total)
+        return penalized_total
+
+    async def run(self, bot: Bot, interval: float):
+        # Bir nechta replikada ham getChatMember yuklamasi bitta sweeper niki
+        await run_leased("penalty_sweep", interval, lambda renew: self.sweep(bot, renew))
+
+penalty_sweeper = PenaltySweeper(settings.penalty_sweep_rate, settings.penalty_sweep_batch_size)
+
+# ==================== REACHABILITY ====================
+def is_unreachable_error(error: Exception) -> bool:
+    """Bot bloklangan, akkaunt o'chirilgan yoki chat topilmadi"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and "chat not found" in error.message.lower()
+
+async def mark_unreachable(session, telegram_ids: Iterable[int]) -> int:
+    """Foydalanuvchilarni broadcastdan chiqarish (chaqiruvchi commit qiladi)"""
+    telegram_ids = set(telegram_ids)
+    if not telegram_ids:
+        return 0
+    result = await session.execute(
+        update(User)
+        .where(User.telegram_id.in_(telegram_ids), User.is_reachable == True)
+        .values(is_reachable=False, blocked_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    await bump_counter(session, STAT_USERS_UNREACHABLE, result.rowcount)
+    return result.rowcount
+
+async def mark_reachable(session, telegram_ids: Iterable[int]) -> int:
+    telegram_ids = set(telegram_ids)
+    if not telegram_ids:
+        return 0
+    result = await session.execute(
+        update(User)
+        .where(User.telegram_id.in_(telegram_ids), User.is_reachable == False)
+        .values(is_reachable=True, blocked_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    await bump_counter(session, STAT_USERS_UNREACHABLE, -result.rowcount)
+    return result.rowcount
+
+class ReachabilityProbe:
+    """Botni bloklagan foydalanuvchilarni sekin tekshirib, qaytganlarini tiklash.
+
+    sendChatAction bloklangan bo'lsa 403 qaytaradi. Blokdan chiqargan
+    foydalanuvchi bir necha soniya "typing..." ni ko'radi - bu faqat bir marta,
+    chunki muvaffaqiyatdan keyin u tiklanadi va boshqa tekshirilmaydi. So'rovlar alohida past TokenBucket bilan cheklanadi va umumiy
+    limitdan ham o'tadi, shuning uchun broadcast va bildirishnomalarga xalaqit bermaydi.
+    """
+
+    def __init__(self, rate: float, batch_size: int):
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.last_user_id = 0
+        self.checked = 0
+        self.restored = 0
+
+    async def _is_reachable(self, bot: Bot, chat_id: int) -> Optional[bool]:
+        """None - aniqlab bo'lmadi"""
+        await self.bucket.acquire()
+        await telegram_limiter.acquire(chat_id)
+        try:
+            await bot.send_chat_action(chat_id, "typing")
+            return True
+        except TelegramRetryAfter as e:
+            telegram_limiter.block(e.retry_after)
+            return None
+        except Exception as e:
+            if is_unreachable_error(e):
+                return False
+            logger.debug("Reachability probe failed for %s: %s", chat_id, e)
+            return None
+
+    async def _next_batch(self):
+        async with async_session_maker() as session:
+            result = await session.execute(
+                select(User.id, User.telegram_id)
+                .where(User.is_reachable == False, User.id > self.last_user_id)
+                .order_by(User.id)
+                .limit(self.batch_size)
             )
+            return result.all()
+
+    async def probe(self, bot: Bot, renew: Optional[Callable[[], Awaitable[bool]]] = None) -> int:
+        """Bitta to'liq aylanish, tiklangan foydalanuvchilar sonini qaytaradi"""
+        self.last_user_id = 0
+        restored_total = 0
+        while True:
+            if renew and not await renew():
+                logger.warning("Reachability probe lease lost, stopping")
+                break
+            rows = await self._next_batch()
+            if not rows:
+                break
+            self.last_user_id = rows[-1].id
             
-    except Exception:
-        await message.answer("❌ Xabar yuborishda xatolik yuz berdi!")
+            back = []
+            for row in rows:
+                if await self._is_reachable(bot, row.telegram_id):
+                    back.append(row.telegram_id)
+                self.checked += 1
+            
+            if back:
+                async with async_session_maker() as session:
+                    restored = await mark_reachable(session, back)
+                    await session.commit()
+                restored_total += restored
+                self.restored += restored
+        logger.info("Reachability probe finished: %s users restored", restored_total)
+        return restored_total
+
+    async def run(self, bot: Bot, interval: float):
+        # Bir nechta replikada ham faqat bitta probe ishlaydi
+        await run_leased("reachability_probe", interval, lambda renew: self.probe(bot, renew))
+
+reachability_probe = ReachabilityProbe(settings.reachability_probe_rate, settings.reachability_probe_batch_size)
+
+# ==================== WEBHOOK ====================
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+def build_web_app(bot: Bot) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/health", health_handler)
+    # Update javobdan oldin to'liq qayta ishlanadi: replika to'xtasa Telegram uni qayta yuboradi
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=False,
+        secret_token=settings.webhook_secret or None,
+    ).register(app, path=settings.webhook_path)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def start_metrics_server() -> web.AppRunner:
+    """/metrics va /health uchun alohida listener (metrics_host:metrics_port).
+
+    Webhook ilovasidan ajratilgan, shuning uchun ochiq portda ko'rinmaydi.
+    """
+    app = web.Application()
+    app.router.add_get("/health", health_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, settings.metrics_host, settings.metrics_port).start()
+    logger.info("Metrics server started on %s:%s", settings.metrics_host, settings.metrics_port)
+    return runner
+
+async def run_webhook(bot: Bot):
+    if not settings.webhook_url:
+        raise RuntimeError("WEBHOOK_URL sozlanmagan")
+    if not settings.webhook_secret:
+        # Sirsiz har kim soxta update yuborishi mumkin
+        raise RuntimeError("WEBHOOK_SECRET sozlanmagan")
+    
+    # Bir xil URL bilan qayta o'rnatish xavfsiz, shuning uchun har bir replika o'rnatadi
+    await bot.set_webhook(
+        settings.webhook_url.rstrip("/") + settings.webhook_path,
+        secret_token=settings.webhook_secret,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    
+    runner = web.AppRunner(build_web_app(bot))
+    await runner.setup()
+    site = web.TCPSite(runner, settings.web_host, settings.web_port)
+    await site.start()
+    logger.info("Webhook server started on %s:%s%s", settings.web_host, settings.web_port, settings.webhook_path)
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop_event.wait()
+    finally:
+        # Yangi so'rovlar qabul qilinmaydi, ishlayotganlari tugashi kutiladi.
+        # Webhook o'chirilmaydi - boshqa replikalar ishlashda davom etadi.
+        logger.info("Webhook server stopping...")
+        await runner.cleanup()
 
 # ==================== MAIN ====================
 async def main():
     await init_db()
+    await channel_store.init(settings.sponsor_channels_list)
+    spawn_background(channel_store.poll(settings.channels_poll_interval))
+    spawn_background(stats_recompute_loop(settings.stats_recompute_interval))
     bot = Bot(token=settings.bot_token)
-    await dp.start_polling(bot)
+    bot.session.middleware(ApiMetricsMiddleware())
+    await bot_identity.refresh(bot)
+    dp["bot_identity"] = bot_identity
+    spawn_background(notification_outbox.run(bot))
+    if settings.penalty_sweep_interval > 0:
+        spawn_background(penalty_sweeper.run(bot, settings.penalty_sweep_interval))
+    if settings.reachability_probe_interval > 0:
+        spawn_background(reachability_probe.run(bot, settings.reachability_probe_interval))
+    spawn_background(broadcast_resume_loop(bot, settings.broadcast_lease))
+    metrics_runner = await start_metrics_server() if settings.metrics_enabled else None
+    try:
+        if settings.run_mode == "webhook":
+            await run_webhook(bot)
+        else:
+            # Oldin webhook o'rnatilgan bo'lsa getUpdates ishlamaydi
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
+    log_listener = setup_logging()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("🛑 Bot to'xtatildi")
-    except Exception as e:
-        print(f"❌ Xatolik: {e}")
+        logger.info("🛑 Bot to'xtatildi")
+    except Exception:
+        logger.exception("❌ Xatolik")
         sys.exit(1)
+    finally:
+        log_listener.stop()